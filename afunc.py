@@ -1,16 +1,43 @@
+import sys
+import weakref
+
+
 class AFunc(object):
     """
     AFunc stands for "analyzed function" and represents a function or method in a project.
+    AFuncs are immutable and interned: creating an AFunc for a node name which is already in use returns the existing
+    object, so equal AFuncs are usually identical and can be used as dictionary keys and set members.
     """
-    def __init__(self, function_name=None, class_name=None, module_name=None, node_name=None):
-        if node_name is not None:
-            self.node_name = node_name
-            self.module_name, self.class_name, self.function_name = self.__node_name_to_function(node_name)
-        else:
-            self.module_name = module_name
-            self.class_name = class_name
-            self.function_name = function_name
-            self.node_name = self.__function_to_node_name(self.module_name, self.class_name, self.function_name)
+    __slots__ = ("module_name", "class_name", "function_name", "node_name", "__weakref__")
+
+    __interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, function_name=None, class_name=None, module_name=None, node_name=None):
+        if node_name is None:
+            if class_name == 'None':
+                class_name = None
+            node_name = cls.__function_to_node_name(module_name, class_name, function_name)
+        afunc = cls.__interned.get(node_name)
+        if afunc is not None:
+            return afunc
+
+        afunc = super().__new__(cls)
+        module_name, class_name, function_name = cls.__node_name_to_function(node_name)
+        object.__setattr__(afunc, "node_name", sys.intern(node_name))
+        object.__setattr__(afunc, "module_name", module_name)
+        object.__setattr__(afunc, "class_name", class_name)
+        object.__setattr__(afunc, "function_name", function_name)
+        # another thread may have interned the same node name in the meantime, in which case its object wins
+        return cls.__interned.setdefault(node_name, afunc)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"'{type(self).__name__}' object is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"'{type(self).__name__}' object is immutable")
+
+    def __reduce__(self):
+        return AFunc, (None, None, None, self.node_name)
 
     def __repr__(self):
         return self.node_name
@@ -19,7 +46,10 @@ class AFunc(object):
         return self.node_name
 
     def __eq__(self, other):
-        return isinstance(other, AFunc) and self.node_name == other.node_name
+        return self is other or (isinstance(other, AFunc) and self.node_name == other.node_name)
+
+    def __hash__(self):
+        return hash(self.node_name)
 
     def is_test_function(self):
         return self.function_name.startswith(self.get_test_method_prefix())
@@ -27,7 +57,7 @@ class AFunc(object):
     @staticmethod
     def __function_to_node_name(module_name, class_name, function_or_method_name):
         return f"{module_name}::{class_name}.{function_or_method_name}" \
-               if class_name is not None and class_name != 'None' \
+               if class_name is not None \
                else f"{module_name}::{function_or_method_name}"
 
     @staticmethod
@@ -36,18 +66,15 @@ class AFunc(object):
         Converts a node name in the format:
         - 'ModuleName::ClassName.method_name' (method in a class)
         - 'ModuleName::FunctionName' (standalone function)
-        Returns a tuple (module_name, class_name, method_name), where class_name or method_name
-        may be None if the node represents a standalone function.
+        Returns a tuple (module_name, class_name, method_name), where class_name is None if the node represents a
+        standalone function. The module name may be a dotted package path (e.g., 'ansible.config.manager') and the
+        class name may be the dotted path of a nested class (e.g., 'Outer.Inner').
         """
-        if '.' in node_name:
-            # This is a method in a class, so we split by '.' first
-            module_class_part, method_name = node_name.split('.')
-            module_name, class_name = module_class_part.split('::')
-            return module_name, class_name, method_name
-        else:
-            # This is a standalone function, so we split only by '::'
-            module_name, function_name = node_name.split('::')
-            return module_name, None, function_name
+        module_name, separator, qualified_name = node_name.partition('::')
+        if separator == '' or qualified_name == '':
+            raise ValueError(f"Invalid node name '{node_name}', expected 'module::[class.]function'.")
+        class_name, _, function_name = qualified_name.rpartition('.')
+        return module_name, class_name or None, function_name
 
     @staticmethod
     def get_test_method_prefix():
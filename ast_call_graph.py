@@ -0,0 +1,425 @@
+import ast
+import hashlib
+import json
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from afunc import AFunc
+from call_graph import CallGraphCreator, Code2FlowCallGraphCreator
+from compact_graph import CompactCallGraph
+
+GLOBAL_SCOPE_NAME = "(global)"
+
+
+class ModuleCallAnalyzer(ast.NodeVisitor):
+    """
+    Collects the functions and methods defined in a module and the calls made by each of them.
+    Like code2flow, the code at the module level is attributed to a '(global)' node and nested functions are
+    considered a part of the function enclosing them.
+    """
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self.definitions = []
+        self.calls = []
+        self.__class_stack = []
+        self.__function_depth = 0
+        self.__current_definition = self.__add_definition(None, GLOBAL_SCOPE_NAME)
+
+    def __add_definition(self, class_name, function_name):
+        node_name = AFunc(function_name=function_name, class_name=class_name, module_name=self.module_name).node_name
+        definition = (node_name, self.module_name, class_name, function_name)
+        self.definitions.append(definition)
+        return definition
+
+    def visit_ClassDef(self, node):
+        self.__class_stack.append(node.name)
+        self.generic_visit(node)
+        self.__class_stack.pop()
+
+    def _visit_function(self, node):
+        if self.__function_depth > 0:
+            self.generic_visit(node)
+            return
+        class_name = self.__class_stack[-1] if len(self.__class_stack) > 0 else None
+        enclosing_definition = self.__current_definition
+        self.__current_definition = self.__add_definition(class_name, node.name)
+        self.__function_depth += 1
+        self.generic_visit(node)
+        self.__function_depth -= 1
+        self.__current_definition = enclosing_definition
+
+    visit_FunctionDef = _visit_function
+    visit_AsyncFunctionDef = _visit_function
+
+    def visit_Call(self, node):
+        caller_node_name, caller_module_name, caller_class_name, _ = self.__current_definition
+        if isinstance(node.func, ast.Name):
+            self.calls.append((caller_node_name, caller_module_name, caller_class_name, None, node.func.id))
+        elif isinstance(node.func, ast.Attribute):
+            owner = node.func.value
+            owner_name = owner.id if isinstance(owner, ast.Name) else owner.attr if isinstance(owner, ast.Attribute) \
+                else None
+            self.calls.append((caller_node_name, caller_module_name, caller_class_name, owner_name, node.func.attr))
+        self.generic_visit(node)
+
+
+def analyze_module(module_path):
+    """
+    Returns the definitions and the calls found in the given module, and None or the error which prevented reading or
+    parsing it (e.g., a Python 2 module or a test data file), in which case the module is skipped. Runs in a worker
+    process.
+    """
+    module_name = os.path.splitext(os.path.basename(module_path))[0]
+    try:
+        with open(module_path, 'r', encoding='utf-8') as f:
+            module_ast = ast.parse(f.read(), filename=module_path)
+    except (SyntaxError, UnicodeDecodeError, ValueError) as e:
+        return [], [], f"{type(e).__name__}: {e}"
+    analyzer = ModuleCallAnalyzer(module_name)
+    analyzer.visit(module_ast)
+    return analyzer.definitions, analyzer.calls, None
+
+
+class CallResolver(object):
+    """
+    Resolves the calls collected by ModuleCallAnalyzer to the definitions they (most likely) invoke, by name only.
+    Similarly to code2flow, calls matching more than max_candidates definitions are considered ambiguous and dropped.
+    """
+    def __init__(self, definitions, max_candidates=1):
+        self.__max_candidates = max_candidates
+        self.__module_functions = {}
+        self.__functions_by_name = {}
+        self.__class_methods = {}
+        self.__methods_by_name = {}
+        for node_name, module_name, class_name, function_name in definitions:
+            if function_name == GLOBAL_SCOPE_NAME:
+                continue
+            if class_name is None:
+                self.__module_functions.setdefault((module_name, function_name), node_name)
+                self.__functions_by_name.setdefault(function_name, []).append(node_name)
+            else:
+                self.__class_methods.setdefault((class_name, function_name), node_name)
+                self.__methods_by_name.setdefault(function_name, []).append(node_name)
+        self.__class_names = {class_name for class_name, _ in self.__class_methods}
+        self.__module_names = {module_name for module_name, _ in self.__module_functions}
+
+    def __find_candidates(self, caller_module_name, caller_class_name, owner_name, function_name):
+        if owner_name is None:
+            if (caller_module_name, function_name) in self.__module_functions:
+                return [self.__module_functions[(caller_module_name, function_name)]]
+            if function_name in self.__class_names:
+                # instantiating a class invokes its constructor
+                constructor = self.__class_methods.get((function_name, "__init__"))
+                return [constructor] if constructor is not None else []
+            return self.__functions_by_name.get(function_name, [])
+        if owner_name in ("self", "cls") and (caller_class_name, function_name) in self.__class_methods:
+            return [self.__class_methods[(caller_class_name, function_name)]]
+        if owner_name in self.__class_names and (owner_name, function_name) in self.__class_methods:
+            return [self.__class_methods[(owner_name, function_name)]]
+        if owner_name in self.__module_names and (owner_name, function_name) in self.__module_functions:
+            return [self.__module_functions[(owner_name, function_name)]]
+        return self.__methods_by_name.get(function_name, [])
+
+    def resolve(self, call):
+        caller_node_name, caller_module_name, caller_class_name, owner_name, function_name = call
+        candidates = self.__find_candidates(caller_module_name, caller_class_name, owner_name, function_name)
+        if len(candidates) > self.__max_candidates:
+            return []
+        return [(caller_node_name, candidate) for candidate in candidates]
+
+
+class AstCallGraphCreator(CallGraphCreator):
+    """
+    Builds the call graph in-process from the ASTs of the modules, without running code2flow and without
+    writing and re-parsing a DOT file. The modules are parsed in parallel by a process pool.
+    If state_path is given, the content hashes and the analysis results of the modules are persisted there and the
+    graph is maintained incrementally: only new or modified modules are re-analyzed, both on creation and by update().
+    The modules which cannot be parsed are left out of the graph and reported by get_build_stats().
+    The paths of the modules a snapshot was built from are saved along with it, so that a snapshot is not reused once
+    modules were added, deleted or moved, even if none of the remaining modules is newer than the snapshot.
+    """
+    MAX_CALL_CANDIDATES = 1
+    PARALLEL_ANALYSIS_THRESHOLD = 8
+    STATE_VERSION = 2
+
+    def __init__(self, source_dir=None, test_dir=None, output_dir=None, dot_file_path=None, snapshot_path=None,
+                 max_workers=None, state_path=None):
+        self.__source_dir = source_dir
+        self.__test_dir = test_dir
+        self.__snapshot_path = snapshot_path
+        self.__max_workers = max_workers
+        self.__state_path = state_path
+        self.__modules = {}
+        self.__modules_num = 0
+        self.__skipped_modules = {}
+        super().__init__(source_dir, test_dir, output_dir, dot_file_path, snapshot_path)
+
+    @staticmethod
+    def find_module_paths(*root_dirs):
+        module_paths = []
+        for root_dir in root_dirs:
+            if root_dir is None:
+                continue
+            for dir_path, _, files in os.walk(os.path.abspath(root_dir)):
+                module_paths.extend(os.path.join(dir_path, f) for f in sorted(files) if f.endswith(".py"))
+        return module_paths
+
+    def _create_compact_graph(self, source_dir, test_dir, output_dir, dot_file_path, snapshot_path):
+        if dot_file_path is not None:
+            # an existing graph was explicitly requested
+            return super()._create_compact_graph(source_dir, test_dir, output_dir, dot_file_path, snapshot_path)
+
+        module_paths = self.find_module_paths(source_dir, test_dir)
+        if self.__state_path is not None:
+            return self.__create_incremental_graph(module_paths)
+
+        if snapshot_path is not None and self.__is_snapshot_of(snapshot_path, module_paths):
+            snapshot_mtime = os.path.getmtime(snapshot_path)
+            if all(os.path.getmtime(module_path) <= snapshot_mtime for module_path in module_paths):
+                return CompactCallGraph.load_snapshot(snapshot_path)
+
+        module_results = self.analyze_modules(module_paths, self.__max_workers)
+        self.__set_skipped_modules(zip(module_paths, module_results))
+        graph = self.link_modules(module_results, self.MAX_CALL_CANDIDATES)
+        if snapshot_path is not None:
+            self.__save_snapshot(graph, snapshot_path, module_paths)
+        return graph
+
+    @staticmethod
+    def get_snapshot_modules_path(snapshot_path):
+        return snapshot_path + ".modules.json"
+
+    def __is_snapshot_of(self, snapshot_path, module_paths):
+        """
+        Tells whether the snapshot exists and was built from the given modules.
+        """
+        snapshot_modules_path = self.get_snapshot_modules_path(snapshot_path)
+        if not os.path.exists(snapshot_path) or not os.path.exists(snapshot_modules_path):
+            return False
+        with open(snapshot_modules_path, 'r', encoding='utf-8') as f:
+            return json.load(f) == sorted(module_paths)
+
+    def __save_snapshot(self, graph, snapshot_path, module_paths):
+        # the module paths are written last: if they are missing or outdated, the snapshot is not reused
+        graph.save_snapshot(snapshot_path)
+        snapshot_modules_path = self.get_snapshot_modules_path(snapshot_path)
+        temp_snapshot_modules_path = snapshot_modules_path + ".tmp"
+        with open(temp_snapshot_modules_path, 'w', encoding='utf-8') as f:
+            json.dump(sorted(module_paths), f)
+        os.replace(temp_snapshot_modules_path, snapshot_modules_path)
+
+    @staticmethod
+    def analyze_modules(module_paths, max_workers=None):
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(analyze_module, module_paths, chunksize=16))
+
+    @staticmethod
+    def build_graph(module_paths, max_workers=None, max_call_candidates=MAX_CALL_CANDIDATES):
+        module_results = AstCallGraphCreator.analyze_modules(module_paths, max_workers)
+        return AstCallGraphCreator.link_modules(module_results, max_call_candidates)
+
+    def __set_skipped_modules(self, module_results):
+        """
+        Keeps the number of modules analyzed and the errors of the modules which could not be, from an iterable of
+        (module path, (definitions, calls, error)).
+        """
+        self.__modules_num = 0
+        self.__skipped_modules = {}
+        for module_path, (_, _, error) in module_results:
+            self.__modules_num += 1
+            if error is not None:
+                self.__skipped_modules[module_path] = error
+        metrics.increment("call_graph.skipped_modules", len(self.__skipped_modules))
+
+    def get_build_stats(self):
+        return {"modules": self.__modules_num, "skipped_modules": dict(self.__skipped_modules)}
+
+    @staticmethod
+    def link_modules(module_results, max_call_candidates=MAX_CALL_CANDIDATES):
+        """
+        Creates the compact graph out of the definitions and calls collected from the modules.
+        """
+        definitions = [definition for module_definitions, _, _ in module_results for definition in module_definitions]
+        node_ids = {}
+        for node_name, _, _, _ in definitions:
+            node_ids.setdefault(node_name, len(node_ids))
+
+        call_resolver = CallResolver(definitions, max_call_candidates)
+        edges = [(node_ids[caller], node_ids[callee])
+                 for _, module_calls, _ in module_results
+                 for call in module_calls
+                 for caller, callee in call_resolver.resolve(call)]
+        return CompactCallGraph.from_edges(list(node_ids.keys()), edges)
+
+    @staticmethod
+    def hash_file(file_path):
+        with open(file_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def __load_state(self):
+        self.__modules = {}
+        if not os.path.exists(self.__state_path):
+            return
+        with open(self.__state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get("version") != self.STATE_VERSION or state.get("max_call_candidates") != self.MAX_CALL_CANDIDATES:
+            # the state was created by an incompatible analysis, start over
+            return
+        for module_path, (content_hash, definitions, calls, error) in state["modules"].items():
+            self.__modules[module_path] = (content_hash, [tuple(d) for d in definitions], [tuple(c) for c in calls],
+                                           error)
+
+    def __save_state(self):
+        state = {"version": self.STATE_VERSION, "max_call_candidates": self.MAX_CALL_CANDIDATES,
+                 "modules": self.__modules}
+        temp_state_path = self.__state_path + ".tmp"
+        with open(temp_state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(temp_state_path, self.__state_path)
+
+    def __reanalyze(self, module_paths):
+        """
+        Re-analyzes the given modules if their content changed and forgets the deleted ones.
+        Returns the paths of the modules whose analysis results changed.
+        """
+        changed_module_paths = []
+        modules_to_analyze = []
+        for module_path in module_paths:
+            if not os.path.exists(module_path):
+                if self.__modules.pop(module_path, None) is not None:
+                    changed_module_paths.append(module_path)
+                continue
+            content_hash = self.hash_file(module_path)
+            if module_path not in self.__modules or self.__modules[module_path][0] != content_hash:
+                modules_to_analyze.append((module_path, content_hash))
+
+        paths_to_analyze = [module_path for module_path, _ in modules_to_analyze]
+        if len(paths_to_analyze) >= self.PARALLEL_ANALYSIS_THRESHOLD:
+            module_results = self.analyze_modules(paths_to_analyze, self.__max_workers)
+        else:
+            module_results = [analyze_module(module_path) for module_path in paths_to_analyze]
+
+        for (module_path, content_hash), (definitions, calls, error) in zip(modules_to_analyze, module_results):
+            # the modules which cannot be parsed are kept too, so that they are not parsed again until they change
+            self.__modules[module_path] = (content_hash, definitions, calls, error)
+            changed_module_paths.append(module_path)
+        self.__set_skipped_modules((module_path, module[1:]) for module_path, module in self.__modules.items())
+        return changed_module_paths
+
+    def __link_all_modules(self):
+        return self.link_modules([self.__modules[module_path][1:] for module_path in sorted(self.__modules)],
+                                 self.MAX_CALL_CANDIDATES)
+
+    def __persist(self, graph):
+        self.__save_state()
+        if self.__snapshot_path is not None:
+            self.__save_snapshot(graph, self.__snapshot_path, self.__modules)
+
+    def __create_incremental_graph(self, module_paths):
+        self.__load_state()
+        removed_module_paths = set(self.__modules) - set(module_paths)
+        changed_module_paths = self.__reanalyze(module_paths + sorted(removed_module_paths))
+        if len(changed_module_paths) == 0 and self.__snapshot_path is not None and \
+                self.__is_snapshot_of(self.__snapshot_path, self.__modules):
+            return CompactCallGraph.load_snapshot(self.__snapshot_path)
+        graph = self.__link_all_modules()
+        self.__persist(graph)
+        return graph
+
+    def __splice(self, previous_definitions, changed_module_paths):
+        """
+        Replaces the edges originating from the changed modules in the current graph.
+        If the set of definitions changed, the calls in other modules may resolve differently, so all the modules
+        are re-linked (from the persisted analysis results, without parsing them again).
+        """
+        current_definitions = {definition for module_path in changed_module_paths if module_path in self.__modules
+                               for definition in self.__modules[module_path][1]}
+        if current_definitions != previous_definitions:
+            return self.__link_all_modules()
+
+        graph = self.get_graph()
+        changed_callers = {definition[0] for definition in current_definitions}
+        changed_caller_ids = {graph.get_node_id(node_name) for node_name in changed_callers}
+        call_resolver = CallResolver([definition for _, definitions, _, _ in self.__modules.values()
+                                      for definition in definitions], self.MAX_CALL_CANDIDATES)
+
+        edges = [(u, v) for u, v in graph.get_edges() if u not in changed_caller_ids]
+        for _, _, calls, _ in self.__modules.values():
+            for call in calls:
+                if call[0] not in changed_callers:
+                    continue
+                edges.extend((graph.get_node_id(caller), graph.get_node_id(callee))
+                             for caller, callee in call_resolver.resolve(call))
+        return CompactCallGraph.from_edges(graph.node_names, edges)
+
+    def __is_analyzed_module(self, file_path):
+        if not file_path.endswith(".py"):
+            return False
+        for root_dir in (self.__source_dir, self.__test_dir):
+            if root_dir is not None and file_path.startswith(os.path.join(os.path.abspath(root_dir), "")):
+                return True
+        return False
+
+    def find_changed_files(self, git_diff_range):
+        """
+        Returns the absolute paths of the files changed in the given git diff range (e.g., 'main...HEAD').
+        """
+        git_dir = self.__source_dir or self.__test_dir
+        repo_root = subprocess.run(["git", "rev-parse", "--show-toplevel"], cwd=git_dir, capture_output=True,
+                                   text=True, check=True).stdout.strip()
+        diff_output = subprocess.run(["git", "diff", "--name-only", git_diff_range], cwd=repo_root,
+                                     capture_output=True, text=True, check=True).stdout
+        return [os.path.join(repo_root, line) for line in diff_output.splitlines() if line.strip() != ""]
+
+    def update(self, changed_files=None, git_diff_range=None):
+        """
+        Re-analyzes the given changed files and/or the files changed in the given git diff range and splices the
+        results into the graph. Returns the paths of the modules that were actually re-analyzed or removed.
+        """
+        if self.__state_path is None:
+            raise ValueError("Incremental updates require a state_path.")
+
+        file_paths = [os.path.abspath(file_path) for file_path in changed_files or []]
+        if git_diff_range is not None:
+            file_paths.extend(self.find_changed_files(git_diff_range))
+        module_paths = sorted({file_path for file_path in file_paths if self.__is_analyzed_module(file_path)})
+
+        previous_definitions = {definition for module_path in module_paths if module_path in self.__modules
+                                for definition in self.__modules[module_path][1]}
+        changed_module_paths = self.__reanalyze(module_paths)
+        if len(changed_module_paths) == 0:
+            return []
+
+        graph = self.__splice(previous_definitions, changed_module_paths)
+        self._set_graph(graph)
+        self.__persist(graph)
+        return changed_module_paths
+
+
+def compare_call_graphs(expected_graph, actual_graph):
+    """
+    Compares two call graphs by node names and returns the differences along with the recall and the precision of
+    the edges of actual_graph with respect to expected_graph (e.g., a graph created by code2flow).
+    """
+    expected_nodes, actual_nodes = set(expected_graph.node_names), set(actual_graph.node_names)
+    expected_edges, actual_edges = set(expected_graph.get_named_edges()), set(actual_graph.get_named_edges())
+    common_edges_num = len(expected_edges & actual_edges)
+    return {
+        "missing_nodes": sorted(expected_nodes - actual_nodes),
+        "extra_nodes": sorted(actual_nodes - expected_nodes),
+        "missing_edges": sorted(expected_edges - actual_edges),
+        "extra_edges": sorted(actual_edges - expected_edges),
+        "edge_recall": common_edges_num / len(expected_edges) if len(expected_edges) > 0 else 1.0,
+        "edge_precision": common_edges_num / len(actual_edges) if len(actual_edges) > 0 else 1.0,
+    }
+
+
+if __name__ == "__main__":
+    source_code_dir = r"C:\Users\ilyak\PycharmProjects\ansible\lib"
+    test_code_dir = r"C:\Users\ilyak\PycharmProjects\ansible\test\units"
+    ast_graph = AstCallGraphCreator(source_dir=source_code_dir, test_dir=test_code_dir).get_graph()
+    code2flow_graph = Code2FlowCallGraphCreator(dot_file_path=r"C:\Users\ilyak\PycharmProjects\callgraph.dot").get_graph()
+    parity = compare_call_graphs(code2flow_graph, ast_graph)
+    print(f"Edge recall: {parity['edge_recall']:.3f}, edge precision: {parity['edge_precision']:.3f}")
@@ -0,0 +1,181 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from afunc import AFunc
+from ast_call_graph import AstCallGraphCreator
+from code_retriever import CodeRetriever
+from hop_analyzer import StaticHopAnalyzer
+from llm import FakeChatModel
+from prompt import PromptGenerator
+from state_graph import HOP_EVALUATION, PATH_EVALUATION, PathEvaluator
+from voting import VotingStrategy
+
+
+def get_function_name(layer, module, function):
+    return f"func_l{layer}_m{module}_f{function}"
+
+
+def generate_synthetic_project(root_dir, depth=4, modules_per_layer=4, functions_per_module=8, fanout=2,
+                               tests_num=50, conditional_call_ratio=0.5, body_lines=10, seed=0):
+    """
+    Writes a synthetic project under root_dir and returns its source and test directories.
+    The source code is made of depth layers of modules, each function calling fanout random functions of the next
+    layer, conditionally with probability conditional_call_ratio. Every test calls a random function of the first
+    layer. body_lines lines of filler code are added to every function to make the prompts realistically long.
+    """
+    rng = random.Random(seed)
+    source_dir = os.path.join(root_dir, "src")
+    test_dir = os.path.join(root_dir, "tests")
+    os.makedirs(source_dir, exist_ok=True)
+    os.makedirs(test_dir, exist_ok=True)
+
+    for layer in range(depth):
+        for module in range(modules_per_layer):
+            imports = set()
+            functions = []
+            for function in range(functions_per_module):
+                lines = [f"def {get_function_name(layer, module, function)}(value):"]
+                lines.extend(f"    value = (value * {i + 3}) % 1009" for i in range(body_lines))
+                if layer + 1 < depth:
+                    for _ in range(fanout):
+                        callee_module = rng.randrange(modules_per_layer)
+                        callee = get_function_name(layer + 1, callee_module, rng.randrange(functions_per_module))
+                        imports.add(f"from layer{layer + 1}_mod{callee_module} import {callee}")
+                        if rng.random() < conditional_call_ratio:
+                            lines.extend([f"    if value % {rng.randint(2, 5)} == 0:", f"        {callee}(value)"])
+                        else:
+                            lines.append(f"    {callee}(value)")
+                lines.append("    return value")
+                functions.append("\n".join(lines))
+            with open(os.path.join(source_dir, f"layer{layer}_mod{module}.py"), 'w') as f:
+                f.write("\n".join(sorted(imports)) + "\n\n\n" + "\n\n\n".join(functions) + "\n")
+
+    tests = []
+    imports = set()
+    for test in range(tests_num):
+        callee_module = rng.randrange(modules_per_layer)
+        callee = get_function_name(0, callee_module, rng.randrange(functions_per_module))
+        imports.add(f"from layer0_mod{callee_module} import {callee}")
+        tests.append(f"def {AFunc.get_test_method_prefix()}synthetic_{test}():\n"
+                     f"    assert {callee}({test}) is not None")
+    with open(os.path.join(test_dir, "test_synthetic.py"), 'w') as f:
+        f.write("\n".join(sorted(imports)) + "\n\n\n" + "\n\n\n".join(tests) + "\n")
+
+    return source_dir, test_dir
+
+
+def find_targets(graph, targets_num):
+    """
+    Returns the targets_num functions reached by the largest numbers of tests.
+    """
+    reaching_tests_nums = []
+    for node_id, node_name in enumerate(graph.node_names):
+        afunc = AFunc(node_name=node_name)
+        if afunc.is_test_function() or not afunc.function_name.startswith("func_"):
+            continue
+        tests_num = sum(1 for ancestor in graph.ancestors(node_id)
+                        if AFunc(node_name=graph.node_names[ancestor]).is_test_function())
+        reaching_tests_nums.append((-tests_num, node_name))
+    return [AFunc(node_name=node_name) for _, node_name in sorted(reaching_tests_nums)[:targets_num]]
+
+
+def run_benchmark(source_dir, test_dir, llm, targets_num=5, max_depth=None, max_paths_per_test=None,
+                  voting_strategy=None, evaluation_mode=HOP_EVALUATION, use_static_prefilter=True,
+                  asynchronous=True):
+    """
+    Selects the tests for the targets_num most tested functions of the project and returns the timings and the
+    counters of every stage.
+    """
+    start_time = time.perf_counter()
+    call_graph_creator = AstCallGraphCreator(source_dir=source_dir, test_dir=test_dir)
+    graph = call_graph_creator.get_graph()
+    graph_loaded_time = time.perf_counter()
+
+    targets = find_targets(graph, targets_num)
+    targets_found_time = time.perf_counter()
+    target_paths = [(target, call_graph_creator.find_all_test_paths(target, max_depth, max_paths_per_test))
+                    for target in targets]
+    paths_found_time = time.perf_counter()
+
+    code_retriever = CodeRetriever(source_dir, test_dir)
+    hop_analyzer = StaticHopAnalyzer(code_retriever) if use_static_prefilter else None
+    path_evaluator = PathEvaluator(llm, PromptGenerator(code_retriever), voting_strategy=voting_strategy,
+                                   hop_analyzer=hop_analyzer, evaluation_mode=evaluation_mode)
+    if asynchronous:
+        _, tests_to_run = asyncio.run(path_evaluator.aevaluate_targets(target_paths))
+    else:
+        _, tests_to_run = path_evaluator.evaluate_targets(target_paths)
+    end_time = time.perf_counter()
+
+    return {
+        "nodes": len(graph),
+        "edges": graph.edges_num,
+        "targets": len(targets),
+        "paths": sum(len(paths) for _, paths in target_paths),
+        "tests_selected": len(tests_to_run),
+        "graph_load_seconds": graph_loaded_time - start_time,
+        "path_enumeration_seconds": paths_found_time - targets_found_time,
+        "evaluation_seconds": end_time - paths_found_time,
+        "wall_seconds": end_time - start_time,
+        **path_evaluator.get_stats(),
+        "llm_input_tokens": llm.input_tokens_num,
+        "llm_output_tokens": llm.output_tokens_num,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the test selection end to end on a synthetic project, "
+                                                 "with a fake LLM.")
+    project_group = parser.add_argument_group("synthetic project")
+    project_group.add_argument("--project-dir", help="Where to generate the project (a temporary directory if omitted)")
+    project_group.add_argument("--depth", type=int, default=4)
+    project_group.add_argument("--modules-per-layer", type=int, default=4)
+    project_group.add_argument("--functions-per-module", type=int, default=8)
+    project_group.add_argument("--fanout", type=int, default=2)
+    project_group.add_argument("--tests", type=int, default=50)
+    project_group.add_argument("--conditional-call-ratio", type=float, default=0.5)
+    project_group.add_argument("--body-lines", type=int, default=10)
+    project_group.add_argument("--seed", type=int, default=0)
+
+    llm_group = parser.add_argument_group("fake LLM")
+    llm_group.add_argument("--positive-ratio", type=float, default=0.7)
+    llm_group.add_argument("--tool-call-ratio", type=float, default=0.0)
+    llm_group.add_argument("--latency", type=float, default=0.05, help="Seconds per LLM call")
+    llm_group.add_argument("--jitter", type=float, default=0.0, help="Seconds")
+
+    evaluation_group = parser.add_argument_group("evaluation")
+    evaluation_group.add_argument("--targets", type=int, default=5)
+    evaluation_group.add_argument("--max-depth", type=int)
+    evaluation_group.add_argument("--max-paths-per-test", type=int)
+    evaluation_group.add_argument("--vote-num", type=int, default=PathEvaluator.MAJORITY_VOTE_NUM)
+    evaluation_group.add_argument("--evaluation-mode", choices=[HOP_EVALUATION, PATH_EVALUATION],
+                                  default=HOP_EVALUATION)
+    evaluation_group.add_argument("--no-static-prefilter", action="store_true")
+    evaluation_group.add_argument("--sync", action="store_true", help="Evaluate the paths sequentially")
+    parser.add_argument("--output", help="A file to write the report to, as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        project_dir = args.project_dir or temp_dir
+        source_dir, test_dir = generate_synthetic_project(project_dir, args.depth, args.modules_per_layer,
+                                                          args.functions_per_module, args.fanout, args.tests,
+                                                          args.conditional_call_ratio, args.body_lines, args.seed)
+        llm = FakeChatModel(positive_ratio=args.positive_ratio, seed=args.seed, tool_call_ratio=args.tool_call_ratio,
+                            latency=args.latency, jitter=args.jitter)
+        report = run_benchmark(source_dir, test_dir, llm, args.targets, args.max_depth, args.max_paths_per_test,
+                               VotingStrategy(vote_num=args.vote_num), args.evaluation_mode,
+                               not args.no_static_prefilter, not args.sync)
+
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,27 @@
 import os
 import subprocess
-import networkx as nx
+from itertools import islice
 
+import metrics
 from afunc import AFunc
+from compact_graph import CompactCallGraph
 
 
 class CallGraphCreator(object):
-    def __init__(self, source_dir=None, test_dir=None, output_dir=None, dot_file_path=None):
+    def __init__(self, source_dir=None, test_dir=None, output_dir=None, dot_file_path=None, snapshot_path=None):
+        """
+        If snapshot_path is given, the graph is memory-mapped from this binary snapshot when it is up to date with
+        the DOT file. Otherwise, the DOT file is parsed and the snapshot is (re)written for the next startup.
+        """
+        self.__node_afuncs = {}
+        with metrics.timed("call_graph.load"):
+            self.__graph = self._create_compact_graph(source_dir, test_dir, output_dir, dot_file_path, snapshot_path)
+
+    def _create_compact_graph(self, source_dir, test_dir, output_dir, dot_file_path, snapshot_path):
         if dot_file_path is None:
             # graph not yet created, create it now
             dot_file_path = self._create_graph(source_dir, test_dir, output_dir)
-        self.__graph = self.__load_graph(dot_file_path)
+        return self.__load_graph(dot_file_path, snapshot_path)
 
     def _create_graph(self, source_dir, test_dir, output_dir):
         output_file_path = os.path.join(output_dir, "callgraph.dot")
@@ -18,50 +29,99 @@ class CallGraphCreator(object):
         print(subprocess.Popen(command_line, shell=True, stdout=subprocess.PIPE).stdout.read())
         return output_file_path
 
-    def __get_node_attr_dict(self):
-        return self.__graph._node
-
     @staticmethod
-    def __load_graph(dot_file):
-        with open(dot_file, 'r') as f:
-            graph = nx.drawing.nx_pydot.read_dot(f)
+    def __load_graph(dot_file, snapshot_path=None):
+        if snapshot_path is None:
+            return CompactCallGraph.from_dot(dot_file)
+        if os.path.exists(snapshot_path) and os.path.getmtime(snapshot_path) >= os.path.getmtime(dot_file):
+            return CompactCallGraph.load_snapshot(snapshot_path)
+        graph = CompactCallGraph.from_dot(dot_file)
+        graph.save_snapshot(snapshot_path)
         return graph
 
+    def get_graph(self):
+        return self.__graph
+
+    def get_build_stats(self):
+        return {}
+
+    def _set_graph(self, graph):
+        self.__graph = graph
+        self.__node_afuncs = {}
+
     def get_node_by_function_name(self, afunc):
-        for node_id, node in self.__get_node_attr_dict().items():
-            if node.get("nname", "").strip("'\"") == afunc.node_name:
-                return node_id
-        return None
+        return self.__graph.get_node_id(afunc.node_name)
 
     @staticmethod
     def __filter_duplicate_paths(paths):
         unique_paths = set(tuple(path) for path in paths)
         return [list(p) for p in unique_paths]
 
-    def find_all_test_paths(self, afunc):
+    def __get_node_afunc(self, node_id):
+        # a single AFunc per node is shared by all the paths going through it
+        afunc = self.__node_afuncs.get(node_id)
+        if afunc is None:
+            afunc = self.__node_afuncs[node_id] = AFunc(node_name=self.__graph.node_names[node_id])
+        return afunc
+
+    def __find_reaching_tests(self, target_node):
+        """
+        Runs a single reverse traversal from the target node and returns its ancestors together with the test nodes
+        found among them.
+        """
+        ancestors = self.__graph.ancestors(target_node)
+        test_nodes = [node_id for node_id in sorted(ancestors) if self.__get_node_afunc(node_id).is_test_function()]
+        return ancestors, test_nodes
+
+    def find_all_test_paths(self, afunc, max_depth=None, max_paths_per_test=None):
         """
         Find all paths that lead to the target function from a test method.
+        Only the tests that can reach the target are considered and the paths are only searched for inside
+        the subgraph of the target's ancestors.
+        max_depth limits the number of calls (edges) in a path and max_paths_per_test limits the number of paths
+        enumerated from each test. Both are unbounded by default.
         """
         target_node = self.get_node_by_function_name(afunc)
         if target_node is None:
             raise Exception(f"Node '{afunc.node_name}' not found in the graph.")
 
-        paths = []
+        with metrics.timed("call_graph.find_paths"):
+            ancestors, test_nodes = self.__find_reaching_tests(target_node)
 
-        for node_id, node in self.__get_node_attr_dict().items():
-            curr_afunc = AFunc(node_name=node.get("nname", "").strip("'\""))
-            if not curr_afunc.function_name.startswith(AFunc.get_test_method_prefix()):
-                continue
-            if node_id == target_node:
-                continue
-            try:
-                for path in nx.all_simple_paths(self.__graph, source=node_id, target=target_node):
-                    paths.append(path)
-            except nx.NetworkXNoPath:
-                continue
+            paths = []
+            for test_node in test_nodes:
+                test_paths = self.__graph.iter_simple_paths(test_node, target_node, allowed_nodes=ancestors,
+                                                            cutoff=max_depth)
+                paths.extend(islice(test_paths, max_paths_per_test))
 
-        return [[AFunc(node_name=self.__get_node_attr_dict()[node_id]["nname"].strip("'\"")) for node_id in p]
-                for p in self.__filter_duplicate_paths(paths)]
+            paths = [[self.__get_node_afunc(node_id) for node_id in p] for p in self.__filter_duplicate_paths(paths)]
+        metrics.increment("call_graph.reaching_tests", len(test_nodes))
+        metrics.increment("call_graph.paths_found", len(paths))
+        return paths
+
+    def iter_test_paths(self, afunc, max_depth=None, max_paths_per_test=None, skip_test=None):
+        """
+        Lazily yields the paths found by find_all_test_paths, test after test, so that they can be evaluated while
+        the graph is still being traversed and without ever holding all of them in memory.
+        skip_test, if given, is called with the test function before each of its paths is produced: once it returns
+        True, the remaining paths of the test are not enumerated.
+        The simple paths from a single test never repeat, so no deduplication is needed.
+        """
+        target_node = self.get_node_by_function_name(afunc)
+        if target_node is None:
+            raise Exception(f"Node '{afunc.node_name}' not found in the graph.")
+
+        ancestors, test_nodes = self.__find_reaching_tests(target_node)
+        metrics.increment("call_graph.reaching_tests", len(test_nodes))
+        for test_node in test_nodes:
+            test_afunc = self.__get_node_afunc(test_node)
+            test_paths = self.__graph.iter_simple_paths(test_node, target_node, allowed_nodes=ancestors,
+                                                        cutoff=max_depth)
+            for path in islice(test_paths, max_paths_per_test):
+                if skip_test is not None and skip_test(test_afunc):
+                    break
+                metrics.increment("call_graph.paths_found")
+                yield [self.__get_node_afunc(node_id) for node_id in path]
 
     def _create_command_line_tool(self, source_dir, test_dir, output_file_path):
         raise NotImplementedError()
@@ -71,26 +131,6 @@ class Code2FlowCallGraphCreator(CallGraphCreator):
     def _create_command_line_tool(self, source_dir, test_dir, output_file_path):
         return f"code2flow -o {output_file_path} --language py {source_dir} {test_dir}"
 
-    def _create_graph(self, source_dir, test_dir, output_dir):
-        output_file_path = super()._create_graph(source_dir, test_dir, output_dir)
-        # due to an annoying bug in pydot, a hack is required here
-        self.__replace_in_file(output_file_path, 'name="', 'nname="')
-        return output_file_path
-
-    @staticmethod
-    def __replace_in_file(file_path, old, new, chunk_size=1024 * 1024):
-        temp_file = file_path + ".tmp"
-
-        with open(file_path, 'r', encoding='utf-8') as infile, open(temp_file, 'w', encoding='utf-8') as outfile:
-            while True:
-                chunk = infile.read(chunk_size)
-                if not chunk:
-                    break
-                outfile.write(chunk.replace(old, new))
-
-        # Replace the original file with the updated one
-        os.replace(temp_file, file_path)
-
 
 if __name__ == "__main__":
     graph_creator = Code2FlowCallGraphCreator(dot_file_path=r"C:\Users\ilyak\PycharmProjects\callgraph.dot")
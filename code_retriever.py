@@ -1,65 +1,94 @@
 import ast
-import os
+import hashlib
+import textwrap
 
+import metrics
 from afunc import AFunc
+from source_cache import SourceFileCache
+from symbol_index import SymbolIndex
 
 
 class CodeRetriever(object):
-    def __init__(self, root_code_dir=None, root_test_dir=None):
+    def __init__(self, root_code_dir=None, root_test_dir=None, preload=False, source_cache=None):
         self.__root_code_dir = root_code_dir
         self.__root_test_dir = root_test_dir
+        self.__source_cache = source_cache if source_cache is not None else SourceFileCache()
+        self.__function_asts = {}
+        self.__symbol_indexes = {root_dir: SymbolIndex(root_dir)
+                                 for root_dir in (root_code_dir, root_test_dir) if root_dir is not None}
+        if preload:
+            self.build_index()
+
+    def build_index(self, max_workers=None):
+        """
+        Indexes all the modules under the root directories in parallel instead of lazily on first access.
+        """
+        for symbol_index in self.__symbol_indexes.values():
+            symbol_index.build(max_workers)
+
+    def refresh_index(self, max_workers=None):
+        for symbol_index in self.__symbol_indexes.values():
+            symbol_index.refresh(max_workers)
+
+    def get_source_cache_stats(self):
+        return self.__source_cache.get_stats()
+
+    def __locate_code(self, function_name, class_name, module_name, root_dir):
+        """
+        Returns the mapped module file and the line spans of the decorators and the body of the given function.
+        """
+        symbol = self.__symbol_indexes[root_dir].find_symbol(module_name, class_name, function_name)
+        if symbol is None:
+            raise ValueError(f"Module '{module_name}' not found in '{root_dir}'.")
 
-    @staticmethod
-    def __find_module_path(root_dir, module_name):
-        for dir_path, _, files in os.walk(root_dir):
-            if f"{module_name}.py" in files:
-                return os.path.join(dir_path, f"{module_name}.py")
-        return None
-
-    @staticmethod
-    def __extract_source_code(node, lines):
-        """Extract the source code of the node from the file's lines."""
-        return ''.join(lines[node.lineno - 1:node.end_lineno])
+        module_path, spans = symbol
+        if spans is None:
+            raise ValueError(f"Function or method '{function_name}' not found in module '{module_name}'.")
 
-    @staticmethod
-    def __extract_decorator(decorator, lines):
-        """Extract the source code for a decorator."""
-        return ''.join(lines[decorator.lineno - 1: decorator.end_lineno])
+        return self.__source_cache.get(module_path), spans
 
     def __retrieve_code(self, function_name, class_name, module_name, root_dir):
-        # Find the module path
-        module_path = self.__find_module_path(root_dir, module_name)
-        if module_path is None:
-            raise ValueError(f"Module '{module_name}' not found in '{root_dir}'.")
-
-        # Read the source code of the module
-        with open(module_path, 'r') as f:
-            source_lines = f.readlines()
-
-        # Parse the module's AST
-        with open(module_path, 'r') as f:
-            module_ast = ast.parse(f.read())
-
-        # Traverse the AST to find the class and function
-        for node in ast.walk(module_ast):
-            if isinstance(node, ast.ClassDef) and class_name is not None and node.name == class_name:
-                # If class is specified, find the function within the class
-                for class_node in node.body:
-                    if isinstance(class_node, ast.FunctionDef) and class_node.name == function_name:
-                        # Extract decorators
-                        decorators = ''.join(self.__extract_decorator(d, source_lines) for d in class_node.decorator_list)
-                        # Extract function code
-                        function_code = self.__extract_source_code(class_node, source_lines)
-                        return decorators + function_code
-            elif isinstance(node, ast.FunctionDef) and class_name is None and node.name == function_name:
-                # If no class is specified, find the standalone function
-                # Extract decorators
-                decorators = ''.join(self.__extract_decorator(d, source_lines) for d in node.decorator_list)
-                # Extract function code
-                function_code = self.__extract_source_code(node, source_lines)
-                return decorators + function_code
-
-        raise ValueError(f"Function or method '{function_name}' not found in module '{module_name}'.")
+        with metrics.timed("code_retriever.retrieve"):
+            mapped_file, spans = self.__locate_code(function_name, class_name, module_name, root_dir)
+            return mapped_file.decode_spans(spans)
+
+    def __get_root_dir(self, afunc):
+        return self.__root_test_dir if afunc.is_test_function() else self.__root_code_dir
+
+    def retrieve_hash(self, afunc):
+        """
+        Returns the SHA-256 digest of the code of the given function, computed without decoding the code.
+        """
+        mapped_file, spans = self.__locate_code(afunc.function_name, afunc.class_name, afunc.module_name,
+                                                self.__get_root_dir(afunc))
+        code_hash = hashlib.sha256()
+        for span_view in mapped_file.iter_spans(spans):
+            code_hash.update(span_view)
+        return code_hash.hexdigest()
+
+    def retrieve_size(self, afunc):
+        """
+        Returns the size in bytes of the code of the given function, without decoding the code.
+        """
+        mapped_file, spans = self.__locate_code(afunc.function_name, afunc.class_name, afunc.module_name,
+                                                self.__get_root_dir(afunc))
+        return sum(end - start for start, end in (mapped_file.get_byte_range(*span) for span in spans))
+
+    def retrieve_ast(self, afunc):
+        """
+        Returns the AST node (ast.FunctionDef or ast.AsyncFunctionDef) of the given function, parsed from its code.
+        The ASTs are kept until the code of the function changes.
+        """
+        code = self.retrieve(afunc)
+        cached_ast = self.__function_asts.get(afunc)
+        if cached_ast is None or cached_ast[0] != code:
+            metrics.increment("code_retriever.ast_cache_misses")
+            with metrics.timed("code_retriever.parse"):
+                cached_ast = (code, ast.parse(textwrap.dedent(code)).body[0])
+            self.__function_asts[afunc] = cached_ast
+        else:
+            metrics.increment("code_retriever.ast_cache_hits")
+        return cached_ast[1]
 
     def retrieve_source(self, afunc):
         return self.__retrieve_code(afunc.function_name, afunc.class_name, afunc.module_name, self.__root_code_dir)
@@ -75,7 +104,11 @@ class CodeRetriever(object):
     def generate_code_extract_func(self):
         def code_extract_func(module_name, class_name, method_or_function_name):
             # TODO: a lot more logic is required here to make this function useful
-            return self.__retrieve_code(method_or_function_name, class_name, module_name, self.__root_code_dir)
+            try:
+                return self.__retrieve_code(method_or_function_name, class_name, module_name, self.__root_code_dir)
+            except ValueError as e:
+                # let the LLM know instead of failing the whole evaluation
+                return f"The code could not be extracted: {e}"
 
         return code_extract_func
 
@@ -0,0 +1,210 @@
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from collections import deque
+
+
+class CompactCallGraph(object):
+    """
+    A compact representation of a call graph.
+    The nodes are identified by consecutive integers and their (interned) names are kept in a list along with a
+    dictionary from names to ids. Both the forward (caller -> callee) and the reverse (callee -> caller) adjacency
+    are kept in CSR form, i.e., the neighbors of node i are neighbors[offsets[i]:offsets[i + 1]].
+    """
+    SNAPSHOT_MAGIC = b"CCGRAPH1"
+    SNAPSHOT_HEADER = struct.Struct("<8sII")
+    INDEX_TYPECODE = 'i'
+
+    __DOT_EDGE_REGEX = re.compile(r'^[\s}]*"?(\w+)"?\s*->\s*"?(\w+)"?')
+    __DOT_NODE_REGEX = re.compile(r'^[\s}]*"?(\w+)"?\s*\[(.*)\]')
+    __DOT_ATTR_REGEX = re.compile(r'(\w+)\s*=\s*"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self, node_names, forward_offsets, forward_targets, reverse_offsets, reverse_sources):
+        self.node_names = node_names
+        self.name_to_id = {name: node_id for node_id, name in enumerate(node_names)}
+        self.forward_offsets = forward_offsets
+        self.forward_targets = forward_targets
+        self.reverse_offsets = reverse_offsets
+        self.reverse_sources = reverse_sources
+        self.__snapshot_buffer = None
+
+    def __len__(self):
+        return len(self.node_names)
+
+    @property
+    def edges_num(self):
+        return len(self.forward_targets)
+
+    @staticmethod
+    def __create_csr(nodes_num, edges):
+        """
+        Converts a sorted list of (u, v) edges into CSR offsets and neighbors arrays.
+        """
+        offsets = array(CompactCallGraph.INDEX_TYPECODE, [0]) * (nodes_num + 1)
+        neighbors = array(CompactCallGraph.INDEX_TYPECODE, (v for _, v in edges))
+        for u, _ in edges:
+            offsets[u + 1] += 1
+        for i in range(nodes_num):
+            offsets[i + 1] += offsets[i]
+        return offsets, neighbors
+
+    @classmethod
+    def from_edges(cls, node_names, edges):
+        """
+        Creates a graph from a list of node names and an iterable of (source id, destination id) edges.
+        Duplicate edges are dropped.
+        """
+        node_names = [sys.intern(name) for name in node_names]
+        unique_edges = sorted(set(edges))
+        forward_offsets, forward_targets = cls.__create_csr(len(node_names), unique_edges)
+        reverse_offsets, reverse_sources = cls.__create_csr(len(node_names), sorted((v, u) for u, v in unique_edges))
+        return cls(node_names, forward_offsets, forward_targets, reverse_offsets, reverse_sources)
+
+    @classmethod
+    def from_dot(cls, dot_file_path):
+        """
+        Parses a DOT file created by code2flow line by line, without building any intermediate DOT object model.
+        The node names are taken from the 'name' attribute (or 'nname', as written by older versions of this tool).
+        Nodes without a name, such as the legend, are skipped.
+        """
+        dot_id_to_node_id = {}
+        node_names = []
+        dot_edges = []
+        with open(dot_file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                edge_match = cls.__DOT_EDGE_REGEX.match(line)
+                if edge_match is not None:
+                    dot_edges.append(edge_match.groups())
+                    continue
+                node_match = cls.__DOT_NODE_REGEX.match(line)
+                if node_match is None:
+                    continue
+                attrs = dict(cls.__DOT_ATTR_REGEX.findall(node_match.group(2)))
+                node_name = attrs.get("name", attrs.get("nname"))
+                if node_name is None:
+                    continue
+                dot_id_to_node_id[node_match.group(1)] = len(node_names)
+                node_names.append(node_name.strip("'\""))
+
+        edges = [(dot_id_to_node_id[u], dot_id_to_node_id[v]) for u, v in dot_edges
+                 if u in dot_id_to_node_id and v in dot_id_to_node_id]
+        return cls.from_edges(node_names, edges)
+
+    def get_node_id(self, node_name):
+        return self.name_to_id.get(node_name)
+
+    def successors(self, node_id):
+        return self.forward_targets[self.forward_offsets[node_id]:self.forward_offsets[node_id + 1]]
+
+    def predecessors(self, node_id):
+        return self.reverse_sources[self.reverse_offsets[node_id]:self.reverse_offsets[node_id + 1]]
+
+    def get_edges(self):
+        for node_id in range(len(self.node_names)):
+            for successor in self.successors(node_id):
+                yield node_id, successor
+
+    def get_named_edges(self):
+        for node_id, successor in self.get_edges():
+            yield self.node_names[node_id], self.node_names[successor]
+
+    def ancestors(self, node_id):
+        """
+        Returns the set of nodes from which the given node is reachable, excluding the node itself.
+        """
+        visited = {node_id}
+        queue = deque([node_id])
+        while len(queue) > 0:
+            for predecessor in self.predecessors(queue.popleft()):
+                if predecessor not in visited:
+                    visited.add(predecessor)
+                    queue.append(predecessor)
+        visited.discard(node_id)
+        return visited
+
+    def iter_simple_paths(self, source, target, allowed_nodes=None, cutoff=None):
+        """
+        Yields the simple paths (as lists of node ids) from source to target, optionally restricted to the given
+        set of nodes and to at most cutoff edges.
+        """
+        if cutoff is None:
+            cutoff = len(self.node_names)
+        if cutoff < 1:
+            return
+        path = [source]
+        on_path = {source}
+        stack = [iter(self.successors(source))]
+        while len(stack) > 0:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                on_path.discard(path.pop())
+                continue
+            if child == target:
+                yield path + [child]
+                continue
+            if child in on_path or (allowed_nodes is not None and child not in allowed_nodes):
+                continue
+            if len(path) < cutoff:
+                path.append(child)
+                on_path.add(child)
+                stack.append(iter(self.successors(child)))
+
+    def save_snapshot(self, snapshot_path):
+        """
+        Writes the graph into a binary file which can be memory-mapped by load_snapshot.
+        The file is written aside and moved onto snapshot_path, as the previous snapshot may still be mapped: truncating
+        it would crash its readers.
+        """
+        encoded_names = [name.encode("utf-8") for name in self.node_names]
+        name_offsets = array(self.INDEX_TYPECODE, [0])
+        for encoded_name in encoded_names:
+            name_offsets.append(name_offsets[-1] + len(encoded_name))
+        arrays = [self.forward_offsets, self.forward_targets, self.reverse_offsets, self.reverse_sources, name_offsets]
+        temp_snapshot_path = snapshot_path + ".tmp"
+        with open(temp_snapshot_path, 'wb') as f:
+            f.write(self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, len(self.node_names), self.edges_num))
+            for index_array in arrays:
+                index_array = array(self.INDEX_TYPECODE, index_array)
+                if sys.byteorder != "little":
+                    index_array.byteswap()
+                f.write(index_array.tobytes())
+            f.write(b"".join(encoded_names))
+        os.replace(temp_snapshot_path, snapshot_path)
+
+    @classmethod
+    def load_snapshot(cls, snapshot_path):
+        """
+        Memory-maps a snapshot written by save_snapshot. The adjacency arrays are used directly from the mapping.
+        """
+        with open(snapshot_path, 'rb') as f:
+            snapshot_buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nodes_num, edges_num = cls.SNAPSHOT_HEADER.unpack_from(snapshot_buffer)
+        if magic != cls.SNAPSHOT_MAGIC:
+            raise ValueError(f"'{snapshot_path}' is not a call graph snapshot.")
+
+        item_size = array(cls.INDEX_TYPECODE).itemsize
+        array_lengths = [nodes_num + 1, edges_num, nodes_num + 1, edges_num, nodes_num + 1]
+        arrays = []
+        position = cls.SNAPSHOT_HEADER.size
+        for array_length in array_lengths:
+            array_view = memoryview(snapshot_buffer)[position:position + array_length * item_size]
+            if sys.byteorder != "little":
+                swapped_array = array(cls.INDEX_TYPECODE, array_view.tobytes())
+                swapped_array.byteswap()
+                arrays.append(swapped_array)
+            else:
+                arrays.append(array_view.cast(cls.INDEX_TYPECODE))
+            position += array_length * item_size
+
+        name_offsets = arrays.pop()
+        names_blob = snapshot_buffer[position:]
+        node_names = [sys.intern(names_blob[name_offsets[i]:name_offsets[i + 1]].decode("utf-8"))
+                      for i in range(nodes_num)]
+
+        graph = cls(node_names, *arrays)
+        graph.__snapshot_buffer = snapshot_buffer
+        return graph
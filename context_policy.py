@@ -0,0 +1,143 @@
+import math
+import re
+
+from langchain_core.messages import HumanMessage, ToolMessage
+
+
+class ContextPolicy(object):
+    """
+    Decides what part of the conversation about a path is sent to the LLM, so that the number of prompt tokens does
+    not grow quadratically with the length of the path:
+    - max_context_hops keeps only the messages of the last hops (None keeps the whole conversation). The first hop,
+      holding the code of the test, is always kept if keep_origin is set;
+    - summarize_verified_hops replaces the dropped hops with a single "call chain so far" line;
+    - deduplicate_tool_outputs replaces the tool outputs already present in the context with a short reference;
+    - max_function_lines truncates the code of long functions to the lines around the call site of the next function
+      on the path (None never truncates), keeping call_site_context_lines lines on each side of the call.
+    The default policy changes nothing, trimming is opted into by setting the limits, SUGGESTED_MAX_CONTEXT_HOPS and
+    SUGGESTED_MAX_FUNCTION_LINES being reasonable starting points.
+    """
+    SUGGESTED_MAX_CONTEXT_HOPS = 2
+    SUGGESTED_MAX_FUNCTION_LINES = 120
+    CHARS_PER_TOKEN = 4
+    DUPLICATE_TOOL_OUTPUT = "The same code was already returned by a previous call of this tool above."
+
+    def __init__(self, max_context_hops=None, keep_origin=True, summarize_verified_hops=True,
+                 deduplicate_tool_outputs=False, max_function_lines=None, call_site_context_lines=10):
+        if max_context_hops is not None and max_context_hops < 1:
+            raise ValueError(f"The number of hops in the context must be positive, got {max_context_hops}.")
+        if max_function_lines is not None and max_function_lines < 1:
+            raise ValueError(f"The number of function lines must be positive, got {max_function_lines}.")
+
+        self.max_context_hops = max_context_hops
+        self.keep_origin = keep_origin
+        self.summarize_verified_hops = summarize_verified_hops
+        self.deduplicate_tool_outputs = deduplicate_tool_outputs
+        self.max_function_lines = max_function_lines
+        self.call_site_context_lines = call_site_context_lines
+
+    @staticmethod
+    def __split_hops(messages):
+        """
+        Splits the conversation into hops, each starting with the prompt of the hop.
+        """
+        hops = []
+        for message in messages:
+            if isinstance(message, HumanMessage) or len(hops) == 0:
+                hops.append([])
+            hops[-1].append(message)
+        return hops
+
+    @staticmethod
+    def create_call_chain_summary(path, verified_hops_num):
+        call_chain = " -> ".join(f"'{afunc}'" for afunc in path[:verified_hops_num + 1])
+        return f"So far it was established that the call chain {call_chain} is executed."
+
+    def trim_messages(self, messages, path):
+        """
+        Returns the messages to send to the LLM out of the whole conversation about the given path.
+        """
+        hops = self.__split_hops(messages)
+        origin_hops_num = 1 if self.keep_origin else 0
+        if self.max_context_hops is not None and len(hops) > self.max_context_hops + origin_hops_num:
+            first_window_hop = len(hops) - self.max_context_hops
+            window_hops = hops[first_window_hop:]
+            if self.summarize_verified_hops:
+                # all the hops before the window were answered positively, otherwise the conversation would be over
+                window_prompt = window_hops[0][0]
+                summary = self.create_call_chain_summary(path, first_window_hop)
+                window_hops[0] = [window_prompt.model_copy(update={"content": f"{summary}\n\n{window_prompt.content}"})] \
+                    + window_hops[0][1:]
+            hops = hops[:origin_hops_num] + window_hops
+
+        trimmed_messages = [message for hop in hops for message in hop]
+        if self.deduplicate_tool_outputs:
+            trimmed_messages = self.__deduplicate_tool_outputs(trimmed_messages)
+        return trimmed_messages
+
+    def __deduplicate_tool_outputs(self, messages):
+        seen_outputs = set()
+        deduplicated_messages = []
+        for message in messages:
+            if isinstance(message, ToolMessage) and isinstance(message.content, str):
+                if message.content in seen_outputs:
+                    message = message.model_copy(update={"content": self.DUPLICATE_TOOL_OUTPUT})
+                else:
+                    seen_outputs.add(message.content)
+            deduplicated_messages.append(message)
+        return deduplicated_messages
+
+    @classmethod
+    def estimate_tokens_num(cls, messages):
+        """
+        Estimates the number of tokens of the given messages (message objects or (role, content) tuples), for the
+        backends not reporting it and for the token budgets of the LLM router.
+        """
+        chars_num = 0
+        for message in messages:
+            content = message[1] if isinstance(message, tuple) else message.content
+            chars_num += len(content) if isinstance(content, str) else len(str(content))
+        return math.ceil(chars_num / cls.CHARS_PER_TOKEN)
+
+    def truncate_code(self, code, callee_name):
+        """
+        Truncates the code of a function longer than max_function_lines to its header and the lines around the calls
+        of callee_name. If there is no such call, the beginning of the function is kept.
+        """
+        lines = code.splitlines()
+        if self.max_function_lines is None or len(lines) <= self.max_function_lines:
+            return code
+
+        header_end = next((i for i, line in enumerate(lines) if line.lstrip().startswith(("def ", "async def "))), 0)
+        call_regex = re.compile(rf"\b{re.escape(callee_name)}\s*\(")
+        call_sites = [i for i, line in enumerate(lines) if i > header_end and call_regex.search(line)]
+
+        kept_lines = set(range(header_end + 1))
+        for call_site in call_sites:
+            context_range = range(max(header_end + 1, call_site - self.call_site_context_lines),
+                                  min(len(lines), call_site + self.call_site_context_lines + 1))
+            if len(kept_lines) + len(context_range) > self.max_function_lines:
+                break
+            kept_lines.update(context_range)
+        if len(call_sites) == 0:
+            kept_lines.update(range(header_end + 1, self.max_function_lines))
+
+        truncated_lines = []
+        omitted_lines_num = 0
+        for i, line in enumerate(lines):
+            if i in kept_lines:
+                if omitted_lines_num > 0:
+                    truncated_lines.append(f"    # ... {omitted_lines_num} lines omitted ...")
+                    omitted_lines_num = 0
+                truncated_lines.append(line)
+            else:
+                omitted_lines_num += 1
+        if omitted_lines_num > 0:
+            truncated_lines.append(f"    # ... {omitted_lines_num} lines omitted ...")
+        return "\n".join(truncated_lines)
+
+    def get_prompt_signature(self):
+        """
+        Returns the settings affecting the text of the hop prompts, for the verdict cache keys.
+        """
+        return self.max_function_lines, self.call_site_context_lines
@@ -0,0 +1,154 @@
+import ast
+
+
+class StaticHopAnalyzer(object):
+    """
+    Decides the trivial hops of the paths from the AST of the source function, without asking the LLM:
+    - a hop is definitely called if the source function calls the destination in an unconditional statement at the
+      top level of its body, with no earlier statement which may return or raise. The call must name the destination
+      without ambiguity: 'name(...)' for a function and 'self.name(...)', 'cls.name(...)' or 'ClassName.name(...)'
+      for a method, as 'x.name(...)' may call a method of any other object;
+    - a hop is definitely not called if the source function does not reference the name of the destination at all;
+    - otherwise the hop is ambiguous and is left to the LLM.
+    Special methods are always ambiguous, as they are usually invoked implicitly (e.g., '__init__' by instantiating
+    the class).
+    """
+    DEFINITELY_CALLED = 'y'
+    DEFINITELY_NOT_CALLED = 'n'
+    AMBIGUOUS = None
+
+    # the nodes whose sub-expressions are not unconditionally evaluated
+    __CONDITIONAL_EXPRESSIONS = (ast.BoolOp, ast.IfExp, ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp,
+                                 ast.GeneratorExp)
+    __NESTED_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+    __BRANCHING_STATEMENTS = (ast.If, ast.For, ast.AsyncFor, ast.While, ast.Try, ast.Match)
+
+    def __init__(self, code_retriever):
+        self.__code_retriever = code_retriever
+        self.__classifications = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.definitely_called_num = 0
+        self.definitely_not_called_num = 0
+        self.ambiguous_num = 0
+
+    @property
+    def llm_calls_avoided(self):
+        return self.definitely_called_num + self.definitely_not_called_num
+
+    def get_stats(self):
+        return {
+            "analyzed_hops": len(self.__classifications),
+            "definitely_called": self.definitely_called_num,
+            "definitely_not_called": self.definitely_not_called_num,
+            "ambiguous": self.ambiguous_num,
+            "llm_calls_avoided": self.llm_calls_avoided,
+        }
+
+    @staticmethod
+    def __is_call_of(node, afunc):
+        if not isinstance(node, ast.Call):
+            return False
+        if afunc.class_name is None:
+            return isinstance(node.func, ast.Name) and node.func.id == afunc.function_name
+        owner_names = ("self", "cls", afunc.class_name, afunc.class_name.rpartition('.')[2])
+        return isinstance(node.func, ast.Attribute) and node.func.attr == afunc.function_name and \
+            isinstance(node.func.value, ast.Name) and node.func.value.id in owner_names
+
+    @classmethod
+    def __iter_unconditional_nodes(cls, node):
+        """
+        Yields the given node and its sub-expressions which are evaluated whenever the node is.
+        """
+        yield node
+        if isinstance(node, cls.__CONDITIONAL_EXPRESSIONS):
+            # only the first operand of a boolean operation is always evaluated
+            if isinstance(node, ast.BoolOp):
+                yield from cls.__iter_unconditional_nodes(node.values[0])
+            elif isinstance(node, ast.IfExp):
+                yield from cls.__iter_unconditional_nodes(node.test)
+            return
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, cls.__NESTED_SCOPES):
+                yield from cls.__iter_unconditional_nodes(child)
+
+    @classmethod
+    def __may_leave(cls, statement):
+        """
+        Returns True if the given statement may return from the function or raise explicitly.
+        """
+        if isinstance(statement, cls.__NESTED_SCOPES):
+            return False
+        if isinstance(statement, (ast.Return, ast.Raise)):
+            return True
+        return any(cls.__may_leave(child) for child in ast.iter_child_nodes(statement)
+                   if isinstance(child, ast.stmt))
+
+    @classmethod
+    def __find_unconditional_call(cls, statements, afunc):
+        """
+        Returns True if one of the given statements calls afunc unconditionally, False if a statement preceding such a
+        call may return or raise, and None if there is neither. The bodies of 'with' blocks are descended into.
+        """
+        for statement in statements:
+            if isinstance(statement, (ast.With, ast.AsyncWith)):
+                if any(cls.__is_call_of(node, afunc)
+                       for item in statement.items for node in cls.__iter_unconditional_nodes(item.context_expr)):
+                    return True
+                found = cls.__find_unconditional_call(statement.body, afunc)
+                if found is not None:
+                    return found
+                continue
+            if not isinstance(statement, cls.__BRANCHING_STATEMENTS + cls.__NESTED_SCOPES):
+                if any(cls.__is_call_of(node, afunc) for node in cls.__iter_unconditional_nodes(statement)):
+                    return True
+            if cls.__may_leave(statement):
+                return False
+        return None
+
+    @staticmethod
+    def __is_referenced(function_node, name):
+        for node in ast.walk(function_node):
+            if isinstance(node, ast.Name) and node.id == name:
+                return True
+            if isinstance(node, ast.Attribute) and node.attr == name:
+                return True
+            # e.g., getattr(obj, 'name')
+            if isinstance(node, ast.Constant) and isinstance(node.value, str) and name in node.value:
+                return True
+        return False
+
+    def __classify(self, source_afunc, destination_afunc):
+        name = destination_afunc.function_name
+        if name.startswith("__") and name.endswith("__"):
+            return self.AMBIGUOUS
+        try:
+            function_node = self.__code_retriever.retrieve_ast(source_afunc)
+        except (ValueError, SyntaxError):
+            return self.AMBIGUOUS
+
+        if self.__find_unconditional_call(function_node.body, destination_afunc):
+            return self.DEFINITELY_CALLED
+        if not self.__is_referenced(function_node, name):
+            return self.DEFINITELY_NOT_CALLED
+        return self.AMBIGUOUS
+
+    def classify_hop(self, path, current_step):
+        """
+        Returns DEFINITELY_CALLED, DEFINITELY_NOT_CALLED or AMBIGUOUS for the given hop.
+        Every call is counted as a hop decided (or not) without the LLM: the callers record the static verdicts in the
+        path trie, so that the hop is only classified once per vote.
+        """
+        key = (path[current_step], path[current_step + 1])
+        if key not in self.__classifications:
+            self.__classifications[key] = self.__classify(path[current_step], path[current_step + 1])
+        classification = self.__classifications[key]
+
+        if classification == self.DEFINITELY_CALLED:
+            self.definitely_called_num += 1
+        elif classification == self.DEFINITELY_NOT_CALLED:
+            self.definitely_not_called_num += 1
+        else:
+            self.ambiguous_num += 1
+        return classification
@@ -0,0 +1,291 @@
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+import metrics
+from afunc import AFunc
+
+
+class TestImpactIndex(object):
+    """
+    A precomputed map from every non-test function of a call graph to the tests reaching it, along with a bounded set
+    of shortest witness paths from each of these tests to the function.
+    The index is built offline by a breadth-first traversal from every test. For each (function, test) pair, it keeps
+    up to max_parents predecessors of the function on shortest paths from the test (each one being reached from the
+    test by a shortest path as well), so the witness paths are rebuilt by walking the predecessors back to the test.
+    At most max_paths_per_test witness paths are rebuilt per pair, as the number of combinations of predecessors
+    grows exponentially with the length of the paths.
+    The pairs are kept in CSR form, sorted by test within each function: the tests reaching node i are
+    tests[test_offsets[i]:test_offsets[i + 1]] and the predecessors of pair p are
+    parents[parent_offsets[p]:parent_offsets[p + 1]]. The test functions only have pairs when they lie on a witness
+    path of a non-test function, and cannot be looked up. The index file is memory-mapped, so that a lookup only
+    reads the pages of the target and of its witness paths.
+    """
+    INDEX_MAGIC = b"CTIMPIX2"
+    INDEX_HEADER = struct.Struct("<8sIIIii")
+    INDEX_TYPECODE = 'i'
+    DEFAULT_MAX_PARENTS = 2
+    DEFAULT_MAX_PATHS_PER_TEST = 4
+
+    def __init__(self, node_names, test_offsets, tests, parent_offsets, parents, max_depth=None,
+                 max_paths_per_test=DEFAULT_MAX_PATHS_PER_TEST):
+        if max_paths_per_test < 1:
+            raise ValueError(f"The number of witness paths per test must be positive, got {max_paths_per_test}.")
+        self.node_names = node_names
+        self.name_to_id = {name: node_id for node_id, name in enumerate(node_names)}
+        self.test_offsets = test_offsets
+        self.tests = tests
+        self.parent_offsets = parent_offsets
+        self.parents = parents
+        self.max_depth = max_depth
+        self.max_paths_per_test = max_paths_per_test
+        self.__node_afuncs = {}
+        self.__index_buffer = None
+
+    def __len__(self):
+        return len(self.node_names)
+
+    def __contains__(self, afunc):
+        return afunc.node_name in self.name_to_id and not afunc.is_test_function()
+
+    @property
+    def pairs_num(self):
+        return len(self.tests)
+
+    @classmethod
+    def build(cls, graph, max_depth=None, max_parents=DEFAULT_MAX_PARENTS,
+              max_paths_per_test=DEFAULT_MAX_PATHS_PER_TEST):
+        """
+        Builds the index of a CompactCallGraph. max_depth limits the number of calls (edges) of the witness paths,
+        the tests reaching a function only through longer paths are left out. Unbounded by default.
+        """
+        tests_by_node = [[] for _ in range(len(graph))]
+        is_test_node = [AFunc(node_name=node_name).is_test_function() for node_name in graph.node_names]
+        for test_node in (node_id for node_id in range(len(graph)) if is_test_node[node_id]):
+            node_parents = cls.__find_shortest_path_parents(graph, test_node, max_depth, max_parents)
+            # the tests are visited in increasing order, so that the pairs of every node end up sorted by test
+            for node_id in cls.__find_witness_nodes(node_parents, test_node, is_test_node):
+                tests_by_node[node_id].append((test_node, node_parents[node_id]))
+
+        test_offsets = array(cls.INDEX_TYPECODE, [0])
+        tests = array(cls.INDEX_TYPECODE)
+        parent_offsets = array(cls.INDEX_TYPECODE, [0])
+        parents = array(cls.INDEX_TYPECODE)
+        for node_tests in tests_by_node:
+            for test_node, node_parents in node_tests:
+                tests.append(test_node)
+                parents.extend(node_parents)
+                parent_offsets.append(len(parents))
+            test_offsets.append(len(tests))
+        return cls(list(graph.node_names), test_offsets, tests, parent_offsets, parents, max_depth, max_paths_per_test)
+
+    @staticmethod
+    def __find_shortest_path_parents(graph, test_node, max_depth, max_parents):
+        """
+        Runs a breadth-first traversal of the callees of the test and returns the nodes reached, each one with up to
+        max_parents of its predecessors on shortest paths from the test.
+        """
+        depths = {test_node: 0}
+        node_parents = {}
+        frontier = [test_node]
+        depth = 0
+        while len(frontier) > 0 and (max_depth is None or depth < max_depth):
+            depth += 1
+            next_frontier = []
+            for node_id in frontier:
+                for successor in graph.successors(node_id):
+                    successor_depth = depths.get(successor)
+                    if successor_depth is None:
+                        depths[successor] = depth
+                        node_parents[successor] = [node_id]
+                        next_frontier.append(successor)
+                    elif successor_depth == depth and len(node_parents[successor]) < max_parents:
+                        node_parents[successor].append(node_id)
+            frontier = next_frontier
+        return node_parents
+
+    @staticmethod
+    def __find_witness_nodes(node_parents, test_node, is_test_node):
+        """
+        Returns the nodes reached from the test which need a pair: the non-test functions and the test functions lying
+        on their witness paths.
+        """
+        witness_nodes = {node_id for node_id in node_parents if not is_test_node[node_id]}
+        stack = list(witness_nodes)
+        while len(stack) > 0:
+            for parent in node_parents[stack.pop()]:
+                if parent != test_node and parent not in witness_nodes:
+                    witness_nodes.add(parent)
+                    stack.append(parent)
+        return sorted(witness_nodes)
+
+    def save(self, index_path):
+        """
+        Writes the index into a binary file which can be memory-mapped by load.
+        The file is written aside and moved onto index_path, as the server may still map the previous index while it
+        is rebuilt.
+        """
+        encoded_names = [name.encode("utf-8") for name in self.node_names]
+        name_offsets = array(self.INDEX_TYPECODE, [0])
+        for encoded_name in encoded_names:
+            name_offsets.append(name_offsets[-1] + len(encoded_name))
+        arrays = [self.test_offsets, self.tests, self.parent_offsets, self.parents, name_offsets]
+        temp_index_path = index_path + ".tmp"
+        with open(temp_index_path, 'wb') as f:
+            f.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, len(self.node_names), self.pairs_num, len(self.parents),
+                                           self.max_depth if self.max_depth is not None else -1,
+                                           self.max_paths_per_test))
+            for index_array in arrays:
+                index_array = array(self.INDEX_TYPECODE, index_array)
+                if sys.byteorder != "little":
+                    index_array.byteswap()
+                f.write(index_array.tobytes())
+            f.write(b"".join(encoded_names))
+        os.replace(temp_index_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        """
+        Memory-maps an index written by save. The CSR arrays are used directly from the mapping.
+        """
+        with open(index_path, 'rb') as f:
+            index_buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nodes_num, pairs_num, parents_num, max_depth, max_paths_per_test = \
+            cls.INDEX_HEADER.unpack_from(index_buffer)
+        if magic != cls.INDEX_MAGIC:
+            raise ValueError(f"'{index_path}' is not a test impact index.")
+
+        item_size = array(cls.INDEX_TYPECODE).itemsize
+        array_lengths = [nodes_num + 1, pairs_num, pairs_num + 1, parents_num, nodes_num + 1]
+        arrays = []
+        position = cls.INDEX_HEADER.size
+        for array_length in array_lengths:
+            array_view = memoryview(index_buffer)[position:position + array_length * item_size]
+            if sys.byteorder != "little":
+                swapped_array = array(cls.INDEX_TYPECODE, array_view.tobytes())
+                swapped_array.byteswap()
+                arrays.append(swapped_array)
+            else:
+                arrays.append(array_view.cast(cls.INDEX_TYPECODE))
+            position += array_length * item_size
+
+        name_offsets = arrays.pop()
+        names_blob = index_buffer[position:]
+        node_names = [sys.intern(names_blob[name_offsets[i]:name_offsets[i + 1]].decode("utf-8"))
+                      for i in range(nodes_num)]
+
+        index = cls(node_names, *arrays, max_depth=max_depth if max_depth >= 0 else None,
+                    max_paths_per_test=max_paths_per_test)
+        index.__index_buffer = index_buffer
+        return index
+
+    def __get_node_afunc(self, node_id):
+        afunc = self.__node_afuncs.get(node_id)
+        if afunc is None:
+            afunc = self.__node_afuncs[node_id] = AFunc(node_name=self.node_names[node_id])
+        return afunc
+
+    def __get_node_id(self, afunc):
+        node_id = self.name_to_id.get(afunc.node_name)
+        if node_id is None or afunc.is_test_function():
+            raise Exception(f"Node '{afunc.node_name}' not found in the test impact index.")
+        return node_id
+
+    def __find_pair(self, node_id, test_node):
+        start, end = self.test_offsets[node_id], self.test_offsets[node_id + 1]
+        return bisect.bisect_left(self.tests, test_node, start, end)
+
+    def __iter_witness_paths(self, node_id, test_node, pair):
+        """
+        Yields the witness paths (as lists of node ids) from the test to the node of the given pair.
+        """
+        for parent in self.parents[self.parent_offsets[pair]:self.parent_offsets[pair + 1]]:
+            if parent == test_node:
+                yield [test_node, node_id]
+                continue
+            for path in self.__iter_witness_paths(parent, test_node, self.__find_pair(parent, test_node)):
+                path.append(node_id)
+                yield path
+
+    def get_reaching_tests(self, afunc):
+        node_id = self.__get_node_id(afunc)
+        return [self.__get_node_afunc(test_node)
+                for test_node in self.tests[self.test_offsets[node_id]:self.test_offsets[node_id + 1]]]
+
+    def iter_test_paths(self, afunc, max_paths_per_test=None, skip_test=None):
+        """
+        Yields the witness paths of the given function, test after test, like CallGraphCreator.iter_test_paths does
+        with the paths it enumerates. max_paths_per_test lowers the number of witness paths of each test below the
+        limit the index was built with.
+        """
+        if max_paths_per_test is None or max_paths_per_test > self.max_paths_per_test:
+            max_paths_per_test = self.max_paths_per_test
+        node_id = self.__get_node_id(afunc)
+        start, end = self.test_offsets[node_id], self.test_offsets[node_id + 1]
+        metrics.increment("impact_index.reaching_tests", end - start)
+        for pair in range(start, end):
+            test_node = self.tests[pair]
+            test_afunc = self.__get_node_afunc(test_node)
+            paths_num = 0
+            for path in self.__iter_witness_paths(node_id, test_node, pair):
+                if paths_num == max_paths_per_test or (skip_test is not None and skip_test(test_afunc)):
+                    break
+                paths_num += 1
+                metrics.increment("impact_index.paths_found")
+                yield [self.__get_node_afunc(path_node) for path_node in path]
+
+    def find_all_test_paths(self, afunc, max_paths_per_test=None):
+        """
+        Returns the witness paths of the given function: up to max_paths_per_test shortest paths from every test
+        reaching it.
+        """
+        with metrics.timed("impact_index.lookup"):
+            return list(self.iter_test_paths(afunc, max_paths_per_test))
+
+    def get_stats(self):
+        return {
+            "nodes": len(self.node_names),
+            "pairs": self.pairs_num,
+            "witness_parents": len(self.parents),
+            "max_depth": self.max_depth,
+            "max_paths_per_test": self.max_paths_per_test,
+        }
+
+
+def main():
+    # the call graph creators are only needed by the offline job
+    from project_registry import CALL_GRAPH_CREATORS
+
+    parser = argparse.ArgumentParser(description="Builds the test impact index of a project: the tests reaching every "
+                                                 "function, with their shortest witness paths.")
+    parser.add_argument("--root-code-dir")
+    parser.add_argument("--root-test-dir")
+    parser.add_argument("--dot-file-path")
+    parser.add_argument("--call-graph-backend", choices=list(CALL_GRAPH_CREATORS), default="code2flow")
+    parser.add_argument("--snapshot-path")
+    parser.add_argument("--max-depth", type=int, help="Maximal number of calls of the witness paths")
+    parser.add_argument("--max-parents", type=int, default=TestImpactIndex.DEFAULT_MAX_PARENTS,
+                        help="Maximal number of shortest path predecessors kept per function and test")
+    parser.add_argument("--max-paths-per-test", type=int, default=TestImpactIndex.DEFAULT_MAX_PATHS_PER_TEST,
+                        help="Maximal number of witness paths rebuilt per function and test")
+    parser.add_argument("--output", required=True, help="Where to write the index")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    call_graph_creator = CALL_GRAPH_CREATORS[args.call_graph_backend](source_dir=args.root_code_dir,
+                                                                      test_dir=args.root_test_dir,
+                                                                      dot_file_path=args.dot_file_path,
+                                                                      snapshot_path=args.snapshot_path)
+    index = TestImpactIndex.build(call_graph_creator.get_graph(), args.max_depth, args.max_parents,
+                                  args.max_paths_per_test)
+    index.save(args.output)
+    print({**index.get_stats(), "seconds": time.perf_counter() - start_time})
+
+
+if __name__ == "__main__":
+    main()
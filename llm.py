@@ -1,8 +1,21 @@
+import asyncio
+import copy
+import itertools
+import json
+import os
 import random
+import re
+import threading
+import time
 
+import httpx
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
 from langchain_openai import ChatOpenAI
 from langchain_ollama import ChatOllama
 
+import metrics
+from context_policy import ContextPolicy
+
 
 class DummyLLM(object):
     """
@@ -22,7 +35,409 @@ class DummyLLM(object):
         return "No" if DummyLLM.counter % DummyLLM.NEGATIVE_REPLY_RATIO == 0 else "Yes"
 
 
-def init_coverage_llm():
+class FakeChatModel(object):
+    """
+    An offline chat model for tests and benchmarks, answering the prompts of PromptGenerator without a live LLM.
+    - scripted_replies maps substrings of the prompts to the replies to them ('Yes' or 'No'), the first matching
+      substring wins. The other prompts are answered positively with probability positive_ratio. The draw is seeded
+      with seed and the prompt itself, so that the same prompt always gets the same answer regardless of the order
+      of the calls, and the runs are reproducible.
+    - Path prompts (asking about several hops at once) are answered with a JSON list of per-hop verdicts.
+    - Once tools are bound, a tool call is emitted before answering with probability tool_call_ratio.
+    - Every call sleeps for latency seconds plus a uniform jitter in [-jitter, jitter].
+    The replies carry usage metadata, with the tokens estimated by ContextPolicy.estimate_tokens_num.
+    """
+    __PATH_PROMPT_REGEX = re.compile(r"^(\d+)\. '(.*)' invokes '(.*)'$", re.MULTILINE)
+    __HOP_PROMPT_REGEX = re.compile(r"invoke '([^']*)'")
+
+    def __init__(self, scripted_replies=None, positive_ratio=1.0, seed=0, tool_call_ratio=0.0, latency=0.0,
+                 jitter=0.0, model="fake-coverage-llm"):
+        self.model = model
+        self.scripted_replies = scripted_replies or {}
+        self.positive_ratio = positive_ratio
+        self.tool_call_ratio = tool_call_ratio
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.__random = random.Random(seed)
+        self.__tool_names = []
+        self.__tool_call_ids = itertools.count()
+        self.calls_num = 0
+        self.input_tokens_num = 0
+        self.output_tokens_num = 0
+
+    def bind_tools(self, tools):
+        self.__tool_names = [tool.name for tool in tools]
+        return self
+
+    def __get_verdict(self, prompt):
+        for substring, reply in self.scripted_replies.items():
+            if substring in prompt:
+                return reply
+        return "Yes" if random.Random(f"{self.seed}\0{prompt}").random() < self.positive_ratio else "No"
+
+    def __get_delay(self):
+        return max(0.0, self.latency + self.__random.uniform(-self.jitter, self.jitter))
+
+    def __create_reply(self, messages):
+        self.calls_num += 1
+        last_message = messages[-1]
+        # after a tool call, the reply still answers the last prompt
+        prompt = next(m.content if isinstance(m, HumanMessage) else m[1] for m in reversed(messages)
+                      if isinstance(m, HumanMessage) or (isinstance(m, tuple) and m[0] == "user"))
+
+        if len(self.__tool_names) > 0 and not isinstance(last_message, ToolMessage) and \
+                self.__random.random() < self.tool_call_ratio:
+            callees = self.__HOP_PROMPT_REGEX.findall(prompt)
+            function_name = callees[0].split("::")[-1].split(".")[-1] if len(callees) > 0 else ""
+            reply = AIMessage(content="", tool_calls=[{
+                "name": self.__tool_names[0], "id": f"call_{next(self.__tool_call_ids)}",
+                "args": {"module_name": None, "class_name": None, "method_or_function_name": function_name}}])
+        else:
+            # the scripted replies are matched against the hop as it would be asked about in a hop prompt
+            hops = self.__PATH_PROMPT_REGEX.findall(prompt)
+            if len(hops) > 0:
+                verdicts = [self.__get_verdict(f"'{caller}' invokes '{callee}'").lower() for _, caller, callee in hops]
+                reply = AIMessage(content="[" + ", ".join(f'"{verdict}"' for verdict in verdicts) + "]")
+            else:
+                reply = AIMessage(content=self.__get_verdict(prompt))
+
+        input_tokens_num = ContextPolicy.estimate_tokens_num(messages)
+        output_tokens_num = ContextPolicy.estimate_tokens_num([reply])
+        reply.usage_metadata = {"input_tokens": input_tokens_num, "output_tokens": output_tokens_num,
+                                "total_tokens": input_tokens_num + output_tokens_num}
+        self.input_tokens_num += input_tokens_num
+        self.output_tokens_num += output_tokens_num
+        return reply
+
+    def invoke(self, messages, *args, **kwargs):
+        time.sleep(self.__get_delay())
+        return self.__create_reply(messages)
+
+    async def ainvoke(self, messages, *args, **kwargs):
+        await asyncio.sleep(self.__get_delay())
+        return self.__create_reply(messages)
+
+
+def get_model_name(llm):
+    for attr_name in ("model", "model_name"):
+        model_name = getattr(llm, attr_name, None)
+        if isinstance(model_name, str):
+            return model_name
+    return type(llm).__name__
+
+
+class TokenBucket(object):
+    """
+    Limits the rate of the tokens sent to a backend to tokens_per_minute, allowing bursts of up to a minute worth of
+    tokens. Consuming more tokens than available overdraws the bucket, which delays the next requests.
+    Not thread-safe, the router accesses it under its lock.
+    """
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.__rate = tokens_per_minute / 60.0
+        self.__tokens = float(tokens_per_minute)
+        self.__last_refill_time = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__last_refill_time) * self.__rate)
+        self.__last_refill_time = now
+
+    def get_wait_time(self, tokens_num):
+        """
+        Returns the seconds to wait until tokens_num tokens are available. A request larger than the whole bucket only
+        waits for a full bucket.
+        """
+        self.__refill()
+        return max(0.0, (min(tokens_num, self.capacity) - self.__tokens) / self.__rate)
+
+    def consume(self, tokens_num):
+        self.__refill()
+        self.__tokens -= tokens_num
+
+
+def get_rate_limit_delay(error):
+    """
+    Returns the seconds to wait requested by a rate-limited (HTTP 429) reply, or None if the error is not a rate limit.
+    """
+    response = getattr(error, "response", None)
+    status_code = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status_code != 429:
+        return None
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return LLMBackend.BASE_COOLDOWN
+
+
+class LLMBackend(object):
+    """
+    A chat model served by one endpoint, along with its dispatch limits and health:
+    - at most max_concurrency requests are in flight at once;
+    - at most tokens_per_minute prompt and completion tokens are sent per minute (None for no limit);
+    - the latency of the successful calls is tracked as an exponentially weighted moving average;
+    - after FAILURE_THRESHOLD consecutive failures the backend cools down for BASE_COOLDOWN seconds, doubling with
+      every further failure up to MAX_COOLDOWN. A rate-limited backend cools down for the time it asks for.
+    Not thread-safe, the router accesses it under its lock.
+    """
+    LATENCY_SMOOTHING = 0.3
+    FAILURE_THRESHOLD = 3
+    BASE_COOLDOWN = 1.0
+    MAX_COOLDOWN = 60.0
+
+    def __init__(self, name, model, max_concurrency=4, tokens_per_minute=None):
+        self.name = name
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute is not None else None
+        self.in_flight_num = 0
+        self.latency = None
+        self.calls_num = 0
+        self.errors_num = 0
+        self.consecutive_errors_num = 0
+        self.cooldown_end_time = 0.0
+
+    def is_healthy(self, now):
+        return now >= self.cooldown_end_time
+
+    def get_expected_latency(self):
+        # the backends which did not answer yet are tried first, to learn their latency
+        return (self.latency or 0.0) * (self.in_flight_num + 1)
+
+    def get_wait_time(self, tokens_num):
+        if self.in_flight_num >= self.max_concurrency:
+            return None
+        return self.token_bucket.get_wait_time(tokens_num) if self.token_bucket is not None else 0.0
+
+    def acquire(self, tokens_num):
+        self.in_flight_num += 1
+        if self.token_bucket is not None:
+            self.token_bucket.consume(tokens_num)
+
+    def release(self, reserved_tokens_num, reply=None, latency=None, error=None):
+        """
+        Frees the slot of a call which either succeeded with the given reply, failed with the given error or, if
+        neither is given, was abandoned (e.g., cancelled), in which case the health of the backend is left as it is.
+        """
+        self.in_flight_num -= 1
+        if reply is None and error is None:
+            return
+        self.calls_num += 1
+        if error is not None:
+            self.errors_num += 1
+            self.consecutive_errors_num += 1
+            now = time.monotonic()
+            rate_limit_delay = get_rate_limit_delay(error)
+            if rate_limit_delay is not None:
+                self.cooldown_end_time = max(self.cooldown_end_time, now + rate_limit_delay)
+            elif self.consecutive_errors_num >= self.FAILURE_THRESHOLD:
+                cooldown = self.BASE_COOLDOWN * 2 ** (self.consecutive_errors_num - self.FAILURE_THRESHOLD)
+                self.cooldown_end_time = now + min(cooldown, self.MAX_COOLDOWN)
+            return
+
+        self.consecutive_errors_num = 0
+        self.latency = latency if self.latency is None \
+            else self.LATENCY_SMOOTHING * latency + (1 - self.LATENCY_SMOOTHING) * self.latency
+        usage_metadata = getattr(reply, "usage_metadata", None) or {}
+        if self.token_bucket is not None and "input_tokens" in usage_metadata:
+            # the prompt tokens were estimated when dispatching, charge the actual usage instead
+            self.token_bucket.consume(usage_metadata["input_tokens"] + usage_metadata.get("output_tokens", 0)
+                                      - reserved_tokens_num)
+
+    def get_stats(self):
+        return {
+            "name": self.name,
+            "in_flight": self.in_flight_num,
+            "max_concurrency": self.max_concurrency,
+            "calls": self.calls_num,
+            "errors": self.errors_num,
+            "latency_seconds": self.latency,
+            "healthy": self.is_healthy(time.monotonic()),
+        }
+
+
+class LLMRouter(object):
+    """
+    Spreads the LLM calls over several backends, and exposes invoke, ainvoke and bind_tools like a chat model.
+    Every call goes to the healthy backend with the lowest expected latency which has a free slot and enough tokens
+    left, waiting for one if there is none. If all the backends are cooling down, they are probed anyway rather than
+    stalling the evaluation. A failed call is retried on another backend if there is one, up to max_attempts calls in
+    total, after an exponential backoff with jitter.
+    The tool-bound routers share the backends with the router they come from, so that the limits and the statistics
+    hold across all the evaluations.
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, backends, max_attempts=3, base_backoff=0.5, max_backoff=8.0):
+        if len(backends) == 0:
+            raise ValueError("The LLM router requires at least one backend.")
+        if len({backend.name for backend in backends}) != len(backends):
+            raise ValueError("The names of the LLM backends must be unique.")
+        self.backends = backends
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.__models = {backend.name: backend.model for backend in backends}
+        self.__lock = threading.Lock()
+        self.__random = random.Random()
+
+    @property
+    def model(self):
+        """
+        The names of the models served by the backends, so that the verdicts of different models are told apart.
+        """
+        return "+".join(sorted({get_model_name(backend.model) for backend in self.backends}))
+
+    def bind_tools(self, tools):
+        router = copy.copy(self)
+        router.__models = {backend.name: backend.model.bind_tools(tools) for backend in self.backends}
+        return router
+
+    def __try_acquire(self, tokens_num, failed_backend):
+        """
+        Reserves a slot and tokens_num tokens on the best backend.
+        Returns the backend, or None and the seconds to wait before trying again.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            candidates = [backend for backend in self.backends if backend.is_healthy(now)] or list(self.backends)
+            if failed_backend in candidates and len(candidates) > 1:
+                candidates.remove(failed_backend)
+
+            wait_time = self.POLL_INTERVAL
+            for backend in sorted(candidates, key=LLMBackend.get_expected_latency):
+                backend_wait_time = backend.get_wait_time(tokens_num)
+                if backend_wait_time == 0.0:
+                    backend.acquire(tokens_num)
+                    return backend, 0.0
+                if backend_wait_time is not None:
+                    wait_time = min(wait_time, backend_wait_time)
+            return None, wait_time
+
+    def __release(self, backend, reserved_tokens_num, reply=None, latency=None, error=None):
+        with self.__lock:
+            backend.release(reserved_tokens_num, reply, latency, error)
+        if error is not None:
+            metrics.increment(f"llm.backend.{backend.name}.errors")
+        elif reply is not None:
+            metrics.observe(f"llm.backend.{backend.name}", latency)
+        else:
+            metrics.increment(f"llm.backend.{backend.name}.abandoned")
+
+    def __get_backoff(self, attempt):
+        return min(self.max_backoff, self.base_backoff * 2 ** attempt) * self.__random.uniform(0.5, 1.0)
+
+    def invoke(self, messages, *args, **kwargs):
+        tokens_num = ContextPolicy.estimate_tokens_num(messages)
+        failed_backend = None
+        for attempt in range(self.max_attempts):
+            backend, wait_time = self.__try_acquire(tokens_num, failed_backend)
+            while backend is None:
+                time.sleep(wait_time)
+                backend, wait_time = self.__try_acquire(tokens_num, failed_backend)
+
+            start_time = time.perf_counter()
+            try:
+                reply = self.__models[backend.name].invoke(messages, *args, **kwargs)
+            except BaseException as e:
+                if not isinstance(e, Exception):
+                    # e.g., KeyboardInterrupt: free the slot, without holding it against the backend
+                    self.__release(backend, tokens_num)
+                    raise
+                self.__release(backend, tokens_num, error=e)
+                if attempt + 1 == self.max_attempts:
+                    raise
+                metrics.increment("llm.retries")
+                failed_backend = backend
+                time.sleep(self.__get_backoff(attempt))
+            else:
+                self.__release(backend, tokens_num, reply, time.perf_counter() - start_time)
+                return reply
+
+    async def ainvoke(self, messages, *args, **kwargs):
+        tokens_num = ContextPolicy.estimate_tokens_num(messages)
+        failed_backend = None
+        for attempt in range(self.max_attempts):
+            backend, wait_time = self.__try_acquire(tokens_num, failed_backend)
+            while backend is None:
+                await asyncio.sleep(wait_time)
+                backend, wait_time = self.__try_acquire(tokens_num, failed_backend)
+
+            start_time = time.perf_counter()
+            try:
+                reply = await self.__models[backend.name].ainvoke(messages, *args, **kwargs)
+            except BaseException as e:
+                if not isinstance(e, Exception):
+                    # e.g., the call was cancelled: free the slot, without holding it against the backend
+                    self.__release(backend, tokens_num)
+                    raise
+                self.__release(backend, tokens_num, error=e)
+                if attempt + 1 == self.max_attempts:
+                    raise
+                metrics.increment("llm.retries")
+                failed_backend = backend
+                await asyncio.sleep(self.__get_backoff(attempt))
+            else:
+                self.__release(backend, tokens_num, reply, time.perf_counter() - start_time)
+                return reply
+
+    def get_stats(self):
+        with self.__lock:
+            return [backend.get_stats() for backend in self.backends]
+
+
+DEFAULT_BACKEND_CONCURRENCY = 4
+DEFAULT_BACKEND_TIMEOUT = 120.0
+DEFAULT_LLM_BACKENDS = [{"provider": "ollama", "model": "qwen2.5-coder"}]
+# a JSON list of backend configurations (see create_llm_backend), or the path of a file holding one
+LLM_BACKENDS_ENV_VAR = "COVERAGE_LLM_BACKENDS"
+
+
+def create_llm_backend(config):
+    """
+    Creates a backend from its configuration, a dictionary with:
+    - provider: 'ollama', 'openai', or 'fake' for a FakeChatModel created with the given options (a stand-in for
+      testing the routing offline);
+    - model, base_url and, for OpenAI, api_key (the OPENAI_API_KEY environment variable if omitted);
+    - optionally name (unique among the backends), max_concurrency, tokens_per_minute and timeout (in seconds).
+    The HTTP clients of a backend keep up to max_concurrency keep-alive connections, reused by all its calls.
+    """
+    provider = config.get("provider", "ollama")
+    max_concurrency = config.get("max_concurrency", DEFAULT_BACKEND_CONCURRENCY)
+    timeout = config.get("timeout", DEFAULT_BACKEND_TIMEOUT)
+    name = config.get("name") or f"{provider}:{config.get('base_url') or 'default'}:{config.get('model')}"
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+
+    if provider == "ollama":
+        model = ChatOllama(model=config["model"], base_url=config.get("base_url"),
+                           client_kwargs={"limits": limits, "timeout": timeout})
+    elif provider == "openai":
+        # the retries are left to the router, which can fail over to another backend
+        model = ChatOpenAI(model=config["model"], base_url=config.get("base_url"), api_key=config.get("api_key"),
+                           timeout=timeout, max_retries=0,
+                           http_client=httpx.Client(limits=limits, timeout=timeout),
+                           http_async_client=httpx.AsyncClient(limits=limits, timeout=timeout))
+    elif provider == "fake":
+        model = FakeChatModel(**config.get("options", {}))
+    else:
+        raise ValueError(f"Unknown LLM provider '{provider}', expected one of ['ollama', 'openai', 'fake'].")
+
+    return LLMBackend(name, model, max_concurrency=max_concurrency, tokens_per_minute=config.get("tokens_per_minute"))
+
+
+def load_llm_backend_configs():
+    value = os.environ.get(LLM_BACKENDS_ENV_VAR)
+    if not value:
+        return DEFAULT_LLM_BACKENDS
+    if os.path.isfile(value):
+        with open(value) as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+def init_coverage_llm(backend_configs=None):
     # return DummyLLM()
     # return ChatOpenAI()
-    return ChatOllama(model="qwen2.5-coder")
+    backend_configs = backend_configs if backend_configs is not None else load_llm_backend_configs()
+    return LLMRouter([create_llm_backend(config) for config in backend_configs])
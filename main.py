@@ -1,46 +1,275 @@
+import asyncio
+import json
+from typing import List, Optional
+
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from langchain_core.runnables import chain
 from langserve import add_routes
 import uvicorn
 
+import metrics
 from afunc import AFunc
-from call_graph import Code2FlowCallGraphCreator
-from code_retriever import CodeRetriever
-from llm import init_coverage_llm
+from context_policy import ContextPolicy
+from hop_analyzer import StaticHopAnalyzer
+from metrics import RequestInstrumentation
+from project_registry import ProjectRegistry
 from prompt import PromptGenerator
-from state_graph import PathEvaluator
+from state_graph import HOP_EVALUATION, PathEvaluator
+from verdict_cache import VerdictCache
+from voting import VotingStrategy
 
 from pydantic import BaseModel
 
 
-class GraphExecutionParams(BaseModel):
+class ProjectLocation(BaseModel):
     root_code_dir: str
     root_test_dir: str
+    dot_file_path: Optional[str] = None
+    call_graph_backend: str = "code2flow"
+    snapshot_path: Optional[str] = None
+    # built offline by impact_index.py, used instead of the call graph traversal when up to date
+    impact_index_path: Optional[str] = None
+
+
+class ProjectParams(ProjectLocation):
+    vote_num: Optional[int] = None
+    quorum: Optional[int] = None
+    confidence_threshold: Optional[float] = None
+    use_verdict_cache: bool = True
+    use_static_prefilter: bool = True
+    # "hop" asks about one hop per prompt, "path" about all the remaining hops of a path in a single prompt
+    evaluation_mode: str = HOP_EVALUATION
+    # attach the metrics recorded while handling the request to the response / dump a cProfile of the request
+    trace: bool = False
+    profile: bool = False
+    # opt-in context trimming, None keeps the whole conversation / the whole function bodies
+    max_context_hops: Optional[int] = None
+    max_function_lines: Optional[int] = None
+    deduplicate_tool_outputs: bool = False
+
+
+class GraphExecutionParams(ProjectParams):
     function_name: str
     class_name: str
     module_name: str
-    dot_file_path: str
 
 
-@chain
-def execute_graph(params: GraphExecutionParams):
+class TargetFunction(BaseModel):
+    function_name: str
+    class_name: Optional[str] = None
+    module_name: str
+
+
+class BatchExecutionParams(ProjectParams):
+    targets: List[TargetFunction]
+
+
+VERDICT_CACHE_PATH = "verdict_cache.sqlite"
+PROFILES_DIR = "profiles"
+_verdict_cache = None
+
+
+def get_verdict_cache():
+    global _verdict_cache
+    if _verdict_cache is None:
+        _verdict_cache = VerdictCache(VERDICT_CACHE_PATH)
+    return _verdict_cache
+
+
+project_registry = ProjectRegistry()
+
+
+def get_project(params):
+    return project_registry.get_project(params["root_code_dir"], params["root_test_dir"],
+                                        dot_file_path=params.get("dot_file_path"),
+                                        call_graph_backend=params.get("call_graph_backend") or "code2flow",
+                                        snapshot_path=params.get("snapshot_path"),
+                                        impact_index_path=params.get("impact_index_path"))
+
+
+def create_voting_strategy(params):
+    return VotingStrategy(vote_num=params.get("vote_num") or PathEvaluator.MAJORITY_VOTE_NUM,
+                          quorum=params.get("quorum"),
+                          confidence_threshold=params.get("confidence_threshold"))
+
+
+def create_context_policy(params):
+    return ContextPolicy(max_context_hops=params.get("max_context_hops"),
+                         deduplicate_tool_outputs=params.get("deduplicate_tool_outputs", False),
+                         max_function_lines=params.get("max_function_lines"))
+
+
+def create_path_evaluator(project, params):
+    prompt_generator = PromptGenerator(project.code_retriever, context_policy=create_context_policy(params))
+    hop_analyzer = StaticHopAnalyzer(project.code_retriever) if params.get("use_static_prefilter", True) else None
+    return PathEvaluator(project_registry.get_llm(), prompt_generator, verdict_cache=get_verdict_cache(),
+                         hop_analyzer=hop_analyzer, evaluation_mode=params.get("evaluation_mode") or HOP_EVALUATION)
+
+
+def create_request_instrumentation(params):
+    return RequestInstrumentation(trace=params.get("trace", False),
+                                  profile_dir=PROFILES_DIR if params.get("profile", False) else None)
+
+
+def select_tests(params):
     try:
         target_function = AFunc(function_name=params["function_name"], class_name=params.get("class_name"),
                                 module_name=params["module_name"])
-        paths = Code2FlowCallGraphCreator(dot_file_path=params["dot_file_path"]).find_all_test_paths(target_function)
-        llm = init_coverage_llm()
-        prompt_generator = PromptGenerator(CodeRetriever(root_code_dir=params["root_code_dir"], root_test_dir=params["root_test_dir"]))
-        tests_to_run = PathEvaluator(llm, prompt_generator).evaluate_paths(target_function, paths)
+        project = get_project(params)
+        paths = project.find_all_test_paths(target_function)
+        tests_to_run = create_path_evaluator(project, params).evaluate_paths(target_function, paths, create_voting_strategy(params),
+                                                                     params.get("use_verdict_cache", True))
 
         return "\n".join([str(t) for t in tests_to_run]) if len(tests_to_run) > 0 else "No tests reach the given function."
     except Exception as e:
         return f"Graph execution failed: {str(e)}"
 
 
-def main():
+@chain
+def execute_graph(params: GraphExecutionParams):
+    """
+    Returns the tests to run as text or, if a trace or a profile was requested, a dictionary holding the text under
+    "result" along with the trace and the location of the profile.
+    """
+    instrumentation = create_request_instrumentation(params)
+    with instrumentation.activate():
+        result = select_tests(params)
+    report = instrumentation.get_report()
+    return {"result": result, **report} if len(report) > 0 else result
+
+
+def select_tests_for_targets(params):
+    try:
+        project = get_project(params)
+        target_paths = []
+        errors = {}
+        for target in params["targets"]:
+            # the nested targets may be passed as models rather than dictionaries
+            target = target.model_dump() if isinstance(target, BaseModel) else target
+            target_function = AFunc(function_name=target["function_name"], class_name=target.get("class_name"),
+                                    module_name=target["module_name"])
+            try:
+                target_paths.append((target_function, project.find_all_test_paths(target_function)))
+            except Exception as e:
+                errors[target_function.node_name] = str(e)
+
+        path_evaluator = create_path_evaluator(project, params)
+        tests_by_target, tests_to_run = path_evaluator.evaluate_targets(
+            target_paths, create_voting_strategy(params), params.get("use_verdict_cache", True))
+
+        return {
+            "targets": {target_name: {selection: [str(t) for t in tests] for selection, tests in target_tests.items()}
+                        for target_name, target_tests in tests_by_target.items()},
+            "errors": errors,
+            "tests_to_run": [str(t) for t in tests_to_run],
+            **path_evaluator.get_stats(),
+        }
+    except Exception as e:
+        return {"error": f"Graph execution failed: {str(e)}"}
+
+
+@chain
+def execute_batch(params: BatchExecutionParams):
+    """
+    Selects the tests for several target functions at once. The call graph and the evaluator are only created once,
+    the paths of all the targets are evaluated together and a test selected for one target is not evaluated again.
+    """
+    instrumentation = create_request_instrumentation(params)
+    with instrumentation.activate():
+        result = select_tests_for_targets(params)
+    return {**result, **instrumentation.get_report()}
+
+
+async def stream_test_selection(params):
+    """
+    Yields the events of PathEvaluator.astream_lazy_paths, so that every selected test is reported as soon as its
+    verdict is final. The paths are evaluated while the call graph is still being traversed, the cheapest paths of
+    each test first. The trace and the profile, if requested, are reported by a final "report" event.
+    """
+    instrumentation = create_request_instrumentation(params)
+    with instrumentation.activate():
+        try:
+            target_function = AFunc(function_name=params["function_name"], class_name=params.get("class_name"),
+                                    module_name=params["module_name"])
+            project = await asyncio.to_thread(get_project, params)
+
+            def enumerate_paths(skip_test):
+                return project.iter_test_paths(target_function, skip_test=skip_test)
+
+            async for event in create_path_evaluator(project, params).astream_lazy_paths(
+                    target_function, enumerate_paths, create_voting_strategy(params),
+                    params.get("use_verdict_cache", True)):
+                with instrumentation.suspended():
+                    yield event
+        except Exception as e:
+            with instrumentation.suspended():
+                yield {"event": "error", "message": f"Graph execution failed: {str(e)}"}
+    report = instrumentation.get_report()
+    if len(report) > 0:
+        yield {"event": "report", **report}
+
+
+def create_app():
     app = FastAPI(title="LangChain Server", version="1.0", description="A simple API server demonstrating LLM-based coverage")
     add_routes(app, execute_graph, path="/chain")
-    uvicorn.run(app, host="localhost", port=8000)
+    add_routes(app, execute_batch, path="/batch")
+
+    @app.post("/stream")
+    async def stream_graph(params: GraphExecutionParams):
+        async def server_sent_events():
+            async for event in stream_test_selection(params.model_dump()):
+                yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+        return StreamingResponse(server_sent_events(), media_type="text/event-stream")
+
+    @app.post("/projects/preload")
+    def preload_project(location: ProjectLocation):
+        project = project_registry.preload(location.root_code_dir, location.root_test_dir,
+                                           dot_file_path=location.dot_file_path,
+                                           call_graph_backend=location.call_graph_backend,
+                                           snapshot_path=location.snapshot_path,
+                                           impact_index_path=location.impact_index_path)
+        return project.get_stats()
+
+    @app.get("/projects")
+    def loaded_projects():
+        return project_registry.get_stats()
+
+    @app.post("/projects/invalidate")
+    def invalidate_projects(location: Optional[ProjectLocation] = None):
+        if location is None:
+            project_registry.invalidate()
+        else:
+            project_registry.invalidate(location.root_code_dir, location.root_test_dir,
+                                        dot_file_path=location.dot_file_path,
+                                        call_graph_backend=location.call_graph_backend)
+        return project_registry.get_stats()
+
+    @app.get("/metrics")
+    def process_metrics():
+        return {**metrics.process_metrics.get_snapshot(), "verdict_cache": get_verdict_cache().get_stats(),
+                "projects": project_registry.get_stats(), "llm_backends": project_registry.get_llm_stats()}
+
+    @app.post("/metrics/reset")
+    def reset_metrics():
+        metrics.process_metrics.reset()
+        return metrics.process_metrics.get_snapshot()
+
+    @app.get("/verdict_cache/stats")
+    def verdict_cache_stats():
+        return get_verdict_cache().get_stats()
+
+    @app.post("/verdict_cache/purge")
+    def purge_verdict_cache():
+        get_verdict_cache().purge()
+        return get_verdict_cache().get_stats()
+
+    return app
+
+
+def main():
+    uvicorn.run(create_app(), host="localhost", port=8000)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import os
+import threading
+import time
+import uuid
+
+
+class MetricsRegistry(object):
+    """
+    Thread-safe counters and timers. Every timer keeps the number and the total and maximal duration of its
+    observations, along with a histogram of the durations over LATENCY_BUCKETS (in seconds).
+    """
+    LATENCY_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__timers = {}
+
+    def increment(self, name, value=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.__lock:
+            timer = self.__timers.get(name)
+            if timer is None:
+                timer = self.__timers[name] = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                                               "buckets": [0] * (len(self.LATENCY_BUCKETS) + 1)}
+            timer["count"] += 1
+            timer["total_seconds"] += seconds
+            timer["max_seconds"] = max(timer["max_seconds"], seconds)
+            timer["buckets"][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    def reset(self):
+        with self.__lock:
+            self.__counters.clear()
+            self.__timers.clear()
+
+    def get_snapshot(self):
+        with self.__lock:
+            bucket_names = [f"le_{bucket}" for bucket in self.LATENCY_BUCKETS] + ["le_inf"]
+            return {
+                "counters": dict(self.__counters),
+                "timers": {name: {"count": timer["count"], "total_seconds": timer["total_seconds"],
+                                  "max_seconds": timer["max_seconds"],
+                                  "histogram": dict(zip(bucket_names, timer["buckets"]))}
+                           for name, timer in self.__timers.items()},
+            }
+
+
+# the metrics of the whole process, and those of the request being handled (if it is traced)
+process_metrics = MetricsRegistry()
+_request_metrics = contextvars.ContextVar("request_metrics", default=None)
+# a single profiler can be active at a time in the process
+_profiler_lock = threading.Lock()
+
+
+def increment(name, value=1):
+    process_metrics.increment(name, value)
+    request_metrics = _request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.increment(name, value)
+
+
+def observe(name, seconds):
+    process_metrics.observe(name, seconds)
+    request_metrics = _request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.observe(name, seconds)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Records the duration of the enclosed block under the given timer name.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time)
+
+
+class RequestInstrumentation(object):
+    """
+    The instrumentation of a single request: a trace of the metrics recorded while handling it and, optionally,
+    a cProfile dump written into profile_dir.
+    Only one request is profiled at a time: while a profile is being recorded, the other requests asking for one are
+    handled without it and report a profile_error instead.
+    """
+    def __init__(self, trace=False, profile_dir=None):
+        self.trace = MetricsRegistry() if trace else None
+        self.profile_dir = profile_dir
+        self.profile_path = None
+        self.profile_error = None
+        self.__profiler = None
+
+    def __start_profiler(self):
+        if not _profiler_lock.acquire(blocking=False):
+            self.profile_error = "Another request is being profiled, the profile was skipped."
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # e.g., another profiling tool is active
+            _profiler_lock.release()
+            self.profile_error = f"The profiler could not be started: {e}"
+            return
+        self.__profiler = profiler
+
+    def __stop_profiler(self):
+        profiler, self.__profiler = self.__profiler, None
+        try:
+            profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.profile_path = os.path.join(self.profile_dir,
+                                             f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.prof")
+            profiler.dump_stats(self.profile_path)
+        finally:
+            _profiler_lock.release()
+
+    @contextlib.contextmanager
+    def activate(self):
+        token = _request_metrics.set(self.trace)
+        start_time = time.perf_counter()
+        if self.profile_dir is not None:
+            self.__start_profiler()
+        try:
+            yield self
+        finally:
+            if self.__profiler is not None:
+                self.__stop_profiler()
+            observe("request", time.perf_counter() - start_time)
+            _request_metrics.reset(token)
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """
+        Pauses the profiler (if any) in the enclosed block, e.g., around the yields of a streaming response, during
+        which the work of the other requests is done.
+        """
+        profiler = self.__profiler
+        if profiler is None:
+            yield
+            return
+        profiler.disable()
+        try:
+            yield
+        finally:
+            profiler.enable()
+
+    def get_report(self):
+        """
+        Returns the trace and the location of the profile dump to be attached to the response.
+        """
+        report = {}
+        if self.trace is not None:
+            report["trace"] = self.trace.get_snapshot()
+        if self.profile_path is not None:
+            report["profile_path"] = self.profile_path
+        if self.profile_error is not None:
+            report["profile_error"] = self.profile_error
+        return report
@@ -0,0 +1,48 @@
+class PathScheduler(object):
+    """
+    Decides the order in which the paths are evaluated. The paths are grouped by their origin test, so that the
+    remaining paths of a test can be skipped as soon as one of them is accepted, and the paths of every test are
+    ordered by their estimated cost: the number of hops times the size of the code of the functions sent to the LLM
+    along the path. This way the short and cheap paths are tried first and the deep, expensive ones are only
+    evaluated when the cheap ones are rejected.
+    """
+    # the assumed size of the functions whose code cannot be located
+    DEFAULT_FUNCTION_SIZE = 1000
+
+    def __init__(self, code_retriever):
+        self.__code_retriever = code_retriever
+        self.__function_sizes = {}
+
+    def get_function_size(self, afunc):
+        function_size = self.__function_sizes.get(afunc)
+        if function_size is None:
+            try:
+                function_size = self.__code_retriever.retrieve_size(afunc)
+            except ValueError:
+                function_size = self.DEFAULT_FUNCTION_SIZE
+            self.__function_sizes[afunc] = function_size
+        return function_size
+
+    def estimate_cost(self, path):
+        # the code of the target itself is never sent
+        return (len(path) - 1) * sum(self.get_function_size(afunc) for afunc in path[:-1])
+
+    def get_sort_key(self, path):
+        """
+        Returns the key ordering the paths of a test: their cost, with ties broken by the node names.
+        """
+        return self.estimate_cost(path), [afunc.node_name for afunc in path]
+
+    def schedule(self, paths):
+        """
+        Returns the paths grouped by test, as a list of lists. Within a group the paths are ordered by their cost and
+        the groups are ordered by the cost of their cheapest path. Ties are broken by the node names, so that the
+        order is deterministic.
+        """
+        paths_by_test = {}
+        for path in paths:
+            paths_by_test.setdefault(path[0], []).append((*self.get_sort_key(path), path))
+        for test_paths in paths_by_test.values():
+            test_paths.sort(key=lambda scheduled_path: scheduled_path[:2])
+        ordered_tests = sorted(paths_by_test.items(), key=lambda item: (item[1][0][0], item[0].node_name))
+        return [[path for _, _, path in test_paths] for _, test_paths in ordered_tests]
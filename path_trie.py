@@ -0,0 +1,94 @@
+class PathTrieNode(object):
+    def __init__(self, afunc):
+        self.afunc = afunc
+        self.children = {}
+        self.is_path_end = False
+
+
+class PathTrie(object):
+    """
+    A prefix trie over the paths leading from the tests to the target function.
+    Paths starting at the same test typically share long prefixes. The trie makes sure that every hop, identified by
+    (origin test, hop index, source function, destination function), is only decided once per vote and that the
+    verdict is reused by every path going through this hop.
+    If a persistent verdict cache is given, the verdicts are also looked up in and stored to it, using the keys
+    produced by cache_key_func(path, step, vote).
+    """
+    def __init__(self, paths=None, verdict_cache=None, cache_key_func=None):
+        self.__root = PathTrieNode(None)
+        self.__paths_num = 0
+        self.__hop_verdicts = {}
+        # the hops already looked up in the verdict cache without success, so that it is queried once per hop
+        self.__uncached_hops = set()
+        self.__verdict_cache = verdict_cache
+        self.__cache_key_func = cache_key_func
+        for path in paths or []:
+            self.insert(path)
+
+    def __len__(self):
+        return self.__paths_num
+
+    def __iter__(self):
+        """
+        Iterates over the paths in depth-first order, i.e., paths sharing a prefix are returned one after another.
+        """
+        stack = [(child, [child.afunc]) for child in reversed(list(self.__root.children.values()))]
+        while len(stack) > 0:
+            node, path = stack.pop()
+            if node.is_path_end:
+                yield path
+            for child in reversed(list(node.children.values())):
+                stack.append((child, path + [child.afunc]))
+
+    def insert(self, path):
+        node = self.__root
+        for afunc in path:
+            if afunc not in node.children:
+                node.children[afunc] = PathTrieNode(afunc)
+            node = node.children[afunc]
+        if not node.is_path_end:
+            node.is_path_end = True
+            self.__paths_num += 1
+
+    @staticmethod
+    def get_hop_key(path, step):
+        return path[0], step, path[step], path[step + 1]
+
+    def get_hop_verdict(self, path, step, vote):
+        """
+        Returns a tuple (verdict, messages) if the given hop was already decided in the given vote or None otherwise.
+        The messages are the prompt and the reply exchanged to reach the verdict.
+        """
+        hop_key = (vote, self.get_hop_key(path, step))
+        hop_verdict = self.__hop_verdicts.get(hop_key)
+        if hop_verdict is None and self.__verdict_cache is not None and hop_key not in self.__uncached_hops:
+            cached_verdict = self.__verdict_cache.get(self.__cache_key_func(path, step, vote))
+            if cached_verdict is None:
+                self.__uncached_hops.add(hop_key)
+            else:
+                verdict, prompt, reply = cached_verdict
+                hop_verdict = (verdict, [("user", prompt), ("assistant", reply)])
+                self.__hop_verdicts[hop_key] = hop_verdict
+        return hop_verdict
+
+    def set_hop_verdict(self, path, step, vote, verdict, messages, persist=True):
+        """
+        Records the verdict of the given hop in the given vote, and in the verdict cache if persist is set (the
+        verdicts which are cheap to reach again, such as the static ones, are not persisted).
+        """
+        self.__hop_verdicts[(vote, self.get_hop_key(path, step))] = (verdict, messages)
+        if persist and self.__verdict_cache is not None:
+            prompt, reply = messages
+            self.__verdict_cache.put(self.__cache_key_func(path, step, vote), verdict, prompt[1], reply.content)
+
+    def is_rejected(self, path, vote):
+        """
+        Returns True if one of the hops of the given path was already decided negatively in the given vote.
+        In this case the whole subtree below this hop is pruned.
+        Only the verdicts known in memory are checked: the verdict cache is consulted when the hops are replayed.
+        """
+        for step in range(len(path) - 1):
+            verdict = self.__hop_verdicts.get((vote, self.get_hop_key(path, step)))
+            if verdict is not None and verdict[0] == 'n':
+                return True
+        return False
@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+
+import metrics
+from ast_call_graph import AstCallGraphCreator
+from call_graph import Code2FlowCallGraphCreator
+from code_retriever import CodeRetriever
+from impact_index import TestImpactIndex
+from llm import init_coverage_llm
+
+CALL_GRAPH_CREATORS = {
+    "code2flow": Code2FlowCallGraphCreator,
+    "ast": AstCallGraphCreator,
+}
+
+
+def get_sources_signature(*root_dirs):
+    """
+    Returns a cheap signature of the Python modules under the given directories: their number and latest mtime.
+    """
+    modules_num = 0
+    latest_mtime = 0
+    for root_dir in root_dirs:
+        if root_dir is None:
+            continue
+        for dir_path, _, files in os.walk(root_dir):
+            for file_name in files:
+                if file_name.endswith(".py"):
+                    modules_num += 1
+                    latest_mtime = max(latest_mtime, os.stat(os.path.join(dir_path, file_name)).st_mtime_ns)
+    return modules_num, latest_mtime
+
+
+class LoadedProject(object):
+    """
+    The call graph and the code retriever of a project, kept in memory across requests.
+    If the project has a test impact index at impact_index_path which is up to date with the call graph, the test
+    paths of the targets are read from the index instead of being enumerated from the graph.
+    """
+    def __init__(self, root_code_dir, root_test_dir, dot_file_path=None, call_graph_backend="code2flow",
+                 snapshot_path=None, impact_index_path=None):
+        if call_graph_backend not in CALL_GRAPH_CREATORS:
+            raise ValueError(f"Unknown call graph backend '{call_graph_backend}', "
+                             f"expected one of {list(CALL_GRAPH_CREATORS)}.")
+        if call_graph_backend == "code2flow" and dot_file_path is None:
+            raise ValueError("The code2flow backend requires a dot_file_path.")
+
+        self.root_code_dir = root_code_dir
+        self.root_test_dir = root_test_dir
+        self.dot_file_path = dot_file_path
+        self.call_graph_backend = call_graph_backend
+        self.snapshot_path = snapshot_path
+        self.impact_index_path = impact_index_path
+
+        self.dot_file_mtime = self.__get_dot_file_mtime()
+        self.sources_signature = get_sources_signature(root_code_dir, root_test_dir)
+        self.last_validation_time = time.monotonic()
+        self.call_graph_creator = self.__create_call_graph_creator()
+        self.impact_index_mtime = self.__get_impact_index_mtime()
+        self.impact_index = self.__load_impact_index()
+        self.code_retriever = CodeRetriever(root_code_dir=root_code_dir, root_test_dir=root_test_dir)
+        self.requests_num = 0
+        self.validation_error = None
+
+    def __get_dot_file_mtime(self):
+        return os.path.getmtime(self.dot_file_path) if self.dot_file_path is not None else None
+
+    def __get_impact_index_mtime(self):
+        if self.impact_index_path is None or not os.path.exists(self.impact_index_path):
+            return None
+        return os.path.getmtime(self.impact_index_path)
+
+    def __load_impact_index(self):
+        """
+        Memory-maps the test impact index, unless there is none or it is older than the call graph it was built from.
+        """
+        if self.impact_index_mtime is None:
+            return None
+        graph_mtime = self.dot_file_mtime if self.dot_file_path is not None else self.sources_signature[1] / 1e9
+        if self.impact_index_mtime < graph_mtime:
+            return None
+        return TestImpactIndex.load(self.impact_index_path)
+
+    def attach_impact_index(self, impact_index_path):
+        """
+        Switches the project to the test impact index at impact_index_path, for the projects loaded without it.
+        """
+        self.impact_index_path = impact_index_path
+        self.impact_index_mtime = self.__get_impact_index_mtime()
+        self.impact_index = self.__load_impact_index()
+
+    def find_all_test_paths(self, afunc):
+        impact_index = self.impact_index
+        if impact_index is not None and afunc in impact_index:
+            return impact_index.find_all_test_paths(afunc)
+        return self.call_graph_creator.find_all_test_paths(afunc)
+
+    def iter_test_paths(self, afunc, skip_test=None):
+        impact_index = self.impact_index
+        if impact_index is not None and afunc in impact_index:
+            return impact_index.iter_test_paths(afunc, skip_test=skip_test)
+        return self.call_graph_creator.iter_test_paths(afunc, skip_test=skip_test)
+
+    def __create_call_graph_creator(self):
+        return CALL_GRAPH_CREATORS[self.call_graph_backend](source_dir=self.root_code_dir,
+                                                            test_dir=self.root_test_dir,
+                                                            dot_file_path=self.dot_file_path,
+                                                            snapshot_path=self.snapshot_path)
+
+    def validate(self):
+        """
+        Reloads the parts of the project which are out of date: the call graph if the DOT file changed (or, for the
+        graphs built from the sources, if the sources changed), the symbol index if the sources changed and the test
+        impact index if it was rebuilt or got older than the call graph.
+        A part failing to reload is kept as it was until the files change again, and the error is reported in the
+        stats: the new signatures are recorded first, so that the following validations do not fail on it again.
+        """
+        self.last_validation_time = time.monotonic()
+        dot_file_mtime = self.__get_dot_file_mtime()
+        sources_signature = get_sources_signature(self.root_code_dir, self.root_test_dir)
+        impact_index_mtime = self.__get_impact_index_mtime()
+        sources_changed = sources_signature != self.sources_signature
+        graph_changed = dot_file_mtime != self.dot_file_mtime or (sources_changed and self.dot_file_path is None)
+        impact_index_changed = graph_changed or impact_index_mtime != self.impact_index_mtime
+        if not (graph_changed or sources_changed or impact_index_changed):
+            return
+
+        self.dot_file_mtime = dot_file_mtime
+        self.sources_signature = sources_signature
+        self.impact_index_mtime = impact_index_mtime
+        self.validation_error = None
+        if graph_changed:
+            self.__reload(self.__reload_call_graph)
+        if sources_changed:
+            self.__reload(self.code_retriever.refresh_index)
+        if impact_index_changed:
+            self.__reload(self.__reload_impact_index)
+
+    def __reload_call_graph(self):
+        self.call_graph_creator = self.__create_call_graph_creator()
+
+    def __reload_impact_index(self):
+        self.impact_index = self.__load_impact_index()
+
+    def __reload(self, reload):
+        try:
+            reload()
+        except Exception as e:
+            self.validation_error = f"{type(e).__name__}: {e}"
+            metrics.increment("projects.validation_errors")
+
+    def get_stats(self):
+        graph = self.call_graph_creator.get_graph()
+        return {
+            "root_code_dir": self.root_code_dir,
+            "root_test_dir": self.root_test_dir,
+            "dot_file_path": self.dot_file_path,
+            "call_graph_backend": self.call_graph_backend,
+            "nodes": len(graph),
+            "edges": graph.edges_num,
+            "modules": self.sources_signature[0],
+            "requests": self.requests_num,
+            "source_cache": self.code_retriever.get_source_cache_stats(),
+            "call_graph_build": self.call_graph_creator.get_build_stats(),
+            "validation_error": self.validation_error,
+            "impact_index_path": self.impact_index_path,
+            "impact_index": self.impact_index.get_stats() if self.impact_index is not None else None,
+        }
+
+
+class ProjectSlot(object):
+    """
+    The entry of a project in the registry: the project once loaded, and the lock under which it is loaded.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.project = None
+
+
+class ProjectRegistry(object):
+    """
+    Keeps the loaded projects, keyed by (root_code_dir, root_test_dir, dot_file_path, call_graph_backend), and a shared
+    LLM client so that neither the graphs and source indexes nor the client connections are set up per request.
+    The projects are checked for changes at most once every VALIDATION_INTERVAL seconds. The test impact index is not
+    part of the key: a request giving another impact_index_path than the one the project was loaded with attaches it.
+    The registry lock only guards the map of the projects: a project is loaded under its own lock, so that loading a
+    project does not hold up the requests for the others, and it is validated by a single request at a time, while
+    the other requests keep using it.
+    """
+    VALIDATION_INTERVAL = 5.0
+
+    def __init__(self, llm_factory=init_coverage_llm):
+        self.__llm_factory = llm_factory
+        self.__llm = None
+        self.__llm_lock = threading.Lock()
+        self.__project_slots = {}
+        self.__lock = threading.Lock()
+
+    def get_llm(self):
+        with self.__llm_lock:
+            if self.__llm is None:
+                self.__llm = self.__llm_factory()
+            return self.__llm
+
+    def get_llm_stats(self):
+        """
+        Returns the statistics of the LLM backends, if the LLM is loaded and reports any.
+        """
+        with self.__llm_lock:
+            return self.__llm.get_stats() if hasattr(self.__llm, "get_stats") else None
+
+    @staticmethod
+    def get_project_key(root_code_dir, root_test_dir, dot_file_path=None, call_graph_backend="code2flow"):
+        return root_code_dir, root_test_dir, dot_file_path, call_graph_backend
+
+    def get_project(self, root_code_dir, root_test_dir, dot_file_path=None, call_graph_backend="code2flow",
+                    snapshot_path=None, impact_index_path=None):
+        key = self.get_project_key(root_code_dir, root_test_dir, dot_file_path, call_graph_backend)
+        with self.__lock:
+            project_slot = self.__project_slots.setdefault(key, ProjectSlot())
+
+        with project_slot.lock:
+            project = project_slot.project
+            validation_due = False
+            if project is None:
+                project = project_slot.project = LoadedProject(root_code_dir, root_test_dir, dot_file_path,
+                                                               call_graph_backend, snapshot_path, impact_index_path)
+            elif impact_index_path is not None and impact_index_path != project.impact_index_path:
+                project.attach_impact_index(impact_index_path)
+            elif time.monotonic() - project.last_validation_time >= self.VALIDATION_INTERVAL:
+                # claim the validation, so that the concurrent requests do not validate the project as well
+                project.last_validation_time = time.monotonic()
+                validation_due = True
+            project.requests_num += 1
+
+        if validation_due:
+            project.validate()
+        return project
+
+    def preload(self, root_code_dir, root_test_dir, dot_file_path=None, call_graph_backend="code2flow",
+                snapshot_path=None, impact_index_path=None):
+        """
+        Loads the project ahead of the first request, including the symbol index of all its modules and its test
+        impact index.
+        """
+        project = self.get_project(root_code_dir, root_test_dir, dot_file_path, call_graph_backend, snapshot_path,
+                                   impact_index_path)
+        project.code_retriever.build_index()
+        self.get_llm()
+        return project
+
+    def invalidate(self, root_code_dir=None, root_test_dir=None, dot_file_path=None, call_graph_backend="code2flow"):
+        """
+        Drops the given project, or all the projects if no project is specified.
+        """
+        with self.__lock:
+            if root_code_dir is None:
+                self.__project_slots.clear()
+                return
+            key = self.get_project_key(root_code_dir, root_test_dir, dot_file_path, call_graph_backend)
+            self.__project_slots.pop(key, None)
+
+    def get_stats(self):
+        with self.__lock:
+            projects = [project_slot.project for project_slot in self.__project_slots.values()]
+        return [project.get_stats() for project in projects if project is not None]
@@ -1,9 +1,24 @@
+import json
+import re
+
+import metrics
+from context_policy import ContextPolicy
+
+
 class PromptGenerator(object):
-    def __init__(self, code_retriever, tool_use_enabled=False):
+    # must be increased whenever the prompts change so that the persistently cached verdicts get invalidated
+    TEMPLATE_VERSION = 2
+
+    def __init__(self, code_retriever, tool_use_enabled=False, context_policy=None):
         self.code_retriever = code_retriever
         self.tool_use_enabled = tool_use_enabled
+        self.context_policy = context_policy if context_policy is not None else ContextPolicy()
 
     def create_prompt(self, path, current_step):
+        with metrics.timed("prompt.create"):
+            return self.__create_prompt(path, current_step)
+
+    def __create_prompt(self, path, current_step):
         origin_function = path[0]
         origin_class_and_method_name = origin_function.function_name \
             if origin_function.class_name is None \
@@ -23,7 +38,8 @@ class PromptGenerator(object):
         destination_method_or_function = "function" if source_function.class_name is None else "method"
 
         if current_step == 0:  # i.e., origin_function == source_function
-            origin_function_code = self.code_retriever.retrieve(origin_function)
+            origin_function_code = self.context_policy.truncate_code(self.code_retriever.retrieve(origin_function),
+                                                                     destination_function.function_name)
             prompt = f"Below is the source code of the {origin_method_or_function} '{origin_class_and_method_name}'. " \
                      f"Does '{origin_class_and_method_name}' invoke '{destination_class_and_method_name}' when executed? " \
                      f"Only answer 'yes' or 'no'." \
@@ -31,13 +47,17 @@ class PromptGenerator(object):
                      f"{origin_function_code}"
 
         else:  # source_function is a hop in between origin and destination
-            source_function_code = self.code_retriever.retrieve(source_function)
+            source_function_code = self.context_policy.truncate_code(self.code_retriever.retrieve(source_function),
+                                                                     destination_function.function_name)
             prompt = f"Following the above, below is the source code of the {source_method_or_function} '{source_class_and_method_name}'. " \
                      f"Does '{source_class_and_method_name}' invoke '{destination_class_and_method_name}' when called from '{origin_class_and_method_name}'? " \
                      f"Only answer 'yes' or 'no'." \
                      f"\n\n" \
                      f"{source_function_code}"
 
+        return self.__add_tool_use_instructions(prompt)
+
+    def __add_tool_use_instructions(self, prompt):
         if self.tool_use_enabled:
             prompt += ("\n\nYou have access to a tool called extract_code which gives you the source code of a given function or method. "
                        "The tool accepts the following parameters: "
@@ -48,6 +68,97 @@ class PromptGenerator(object):
 
         return prompt
 
+    def create_path_prompt(self, path, first_step):
+        """
+        Creates a single prompt asking about all the hops of the path from first_step on, to be answered with a
+        list of per-hop verdicts (see analyze_path_reply).
+        """
+        with metrics.timed("prompt.create_path"):
+            return self.__create_path_prompt(path, first_step)
+
+    def __create_path_prompt(self, path, first_step):
+        hops = "\n".join(f"{hop_num}. '{path[step]}' invokes '{path[step + 1]}'"
+                         for hop_num, step in enumerate(range(first_step, len(path) - 1), start=1))
+        functions_code = "\n\n".join(
+            f"Source code of '{path[step]}':\n\n"
+            f"{self.context_policy.truncate_code(self.code_retriever.retrieve(path[step]), path[step + 1].function_name)}"
+            for step in range(first_step, len(path) - 1))
+        prompt = f"Below is the source code of the functions along a call chain executed from the test '{path[0]}'. " \
+                 f"For each of the numbered hops below, does the caller invoke the callee when the chain is executed " \
+                 f"from '{path[0]}' and all the previous hops are taken?" \
+                 f"\n\n" \
+                 f"{hops}" \
+                 f"\n\n" \
+                 f"Only answer with a JSON list holding 'yes' or 'no' for every hop, in order, e.g. [\"yes\", \"no\"]." \
+                 f"\n\n" \
+                 f"{functions_code}"
+        return self.__add_tool_use_instructions(prompt)
+
+    @staticmethod
+    def __to_verdict(answer):
+        if isinstance(answer, bool):
+            return 'y' if answer else 'n'
+        if isinstance(answer, dict):
+            answer = answer.get("verdict", answer.get("answer"))
+        if not isinstance(answer, str):
+            return None
+        answer = answer.strip().lower()
+        if answer.startswith("yes"):
+            return 'y'
+        if answer.startswith("no"):
+            return 'n'
+        return None
+
+    @classmethod
+    def analyze_path_reply(cls, reply, hops_num):
+        """
+        Returns the list of the verdicts ('y' or 'n') on the hops asked about by a path prompt, or None if the reply
+        cannot be parsed. Besides a JSON list, numbered lines such as '1. yes' or 'Hop 2: no' are accepted.
+        """
+        json_match = re.search(r"\[.*\]", reply.content, re.DOTALL)
+        if json_match is not None:
+            try:
+                verdicts = [cls.__to_verdict(answer) for answer in json.loads(json_match.group(0))]
+            except ValueError:
+                verdicts = None
+            if verdicts is not None and len(verdicts) == hops_num and None not in verdicts:
+                return verdicts
+
+        numbered_verdicts = {}
+        for hop_num, answer in re.findall(r"^\W*(?:hop\s*)?(\d+)\b.*?\b(yes|no)\b", reply.content,
+                                          re.IGNORECASE | re.MULTILINE):
+            numbered_verdicts.setdefault(int(hop_num), cls.__to_verdict(answer))
+        if sorted(numbered_verdicts) == list(range(1, hops_num + 1)):
+            return [numbered_verdicts[hop_num] for hop_num in range(1, hops_num + 1)]
+        return None
+
+    @staticmethod
+    def create_static_hop_prompt(path, current_step):
+        """
+        Stands for the prompt of a hop decided by static analysis, so that the conversation still covers every hop.
+        """
+        return f"Does '{path[current_step]}' invoke '{path[current_step + 1]}'? Only answer 'yes' or 'no'."
+
+    def __get_code_hash(self, afunc):
+        try:
+            return self.code_retriever.retrieve_hash(afunc)
+        except ValueError:
+            # the code could not be located, fall back to the name of the function
+            return afunc.node_name
+
+    def get_hop_fingerprint(self, path, current_step):
+        """
+        Returns the hashes of the code the prompt for the given hop is built from: the code of the source and the
+        destination functions and, for the hops following the first one, the code of the origin test.
+        """
+        fingerprint = [self.TEMPLATE_VERSION, self.tool_use_enabled, current_step == 0,
+                       *self.context_policy.get_prompt_signature()]
+        if current_step > 0:
+            fingerprint.append(self.__get_code_hash(path[0]))
+        fingerprint.append(self.__get_code_hash(path[current_step]))
+        fingerprint.append(self.__get_code_hash(path[current_step + 1]))
+        return fingerprint
+
     def create_initial_prompt(self, path, current_step):
         # temporary implementation
         return self.create_prompt(path, current_step)
@@ -0,0 +1,96 @@
+import mmap
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict
+
+
+class MappedSourceFile(object):
+    """
+    A memory-mapped source file along with the byte offsets of its lines.
+    Line spans are sliced straight from the mapping and are only decoded when their text is actually needed.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mtime = stat.st_mtime_ns
+            self.size = stat.st_size
+            # empty files cannot be mapped
+            self.__buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b""
+        self.__line_offsets = array('q', [0])
+        self.__line_offsets.extend(m.end() for m in re.finditer(b"\n", self.__buffer))
+        if self.__line_offsets[-1] != self.size:
+            self.__line_offsets.append(self.size)
+
+    def get_byte_range(self, first_line, last_line):
+        """
+        Returns the byte range of the given lines (1-based, inclusive).
+        """
+        return self.__line_offsets[first_line - 1], self.__line_offsets[min(last_line, len(self.__line_offsets) - 1)]
+
+    def iter_spans(self, spans):
+        """
+        Yields zero-copy views of the given line spans. The views must not be used after the iteration proceeds.
+        """
+        with memoryview(self.__buffer) as buffer_view:
+            for first_line, last_line in spans:
+                start, end = self.get_byte_range(first_line, last_line)
+                with buffer_view[start:end] as span_view:
+                    yield span_view
+
+    def decode_spans(self, spans):
+        text = ''.join(str(span_view, 'utf-8') for span_view in self.iter_spans(spans))
+        # keep the universal newlines behavior of reading the file in text mode
+        return text.replace('\r\n', '\n') if '\r' in text else text
+
+
+class SourceFileCache(object):
+    """
+    A bounded LRU cache of memory-mapped source files.
+    Evicted files are unmapped as soon as no retrieval uses them anymore.
+    """
+    DEFAULT_MAX_FILES = 256
+
+    def __init__(self, max_files=DEFAULT_MAX_FILES):
+        self.__max_files = max_files
+        self.__files = OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, file_path):
+        mtime = os.stat(file_path).st_mtime_ns
+        with self.__lock:
+            mapped_file = self.__files.get(file_path)
+            if mapped_file is not None and mapped_file.mtime == mtime:
+                self.hits += 1
+                self.__files.move_to_end(file_path)
+                return mapped_file
+            self.misses += 1
+
+        mapped_file = MappedSourceFile(file_path)
+        with self.__lock:
+            self.__files[file_path] = mapped_file
+            self.__files.move_to_end(file_path)
+            while len(self.__files) > self.__max_files:
+                self.__files.popitem(last=False)
+                self.evictions += 1
+        return mapped_file
+
+    def clear(self):
+        with self.__lock:
+            self.__files.clear()
+
+    def get_stats(self):
+        with self.__lock:
+            return {
+                "files": len(self.__files),
+                "max_files": self.__max_files,
+                "mapped_bytes": sum(mapped_file.size for mapped_file in self.__files.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -1,23 +1,39 @@
+import asyncio
+import heapq
 import json
+import threading
+import time
 from types import NoneType
 from typing import Annotated, Union
 
-from langchain_core.messages import ToolMessage
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langchain_core.tools import StructuredTool
 from pydantic import BaseModel, Field
 from typing_extensions import TypedDict
 
+from langgraph.errors import GraphRecursionError
 from langgraph.graph import StateGraph, START
 from langgraph.graph.message import add_messages
 
+import metrics
 from afunc import AFunc
 from call_graph import Code2FlowCallGraphCreator
 from code_retriever import CodeRetriever
-from llm import init_coverage_llm
+from context_policy import ContextPolicy
+from llm import get_model_name, init_coverage_llm
+from path_scheduler import PathScheduler
+from path_trie import PathTrie
 from prompt import PromptGenerator
+from verdict_cache import VerdictCache
+from voting import VotingStrategy
 
 ENABLE_CODE_EXTRACT_TOOL = True
 
+# the evaluation modes: one prompt per hop, or one prompt for all the remaining hops of a path
+HOP_EVALUATION = "hop"
+PATH_EVALUATION = "path"
+
 
 class ExtractCodeArgsSchema(BaseModel):
     module_name: Union[str, NoneType] = Field(description="The module containing the code to be extracted or None if unknown.")
@@ -29,48 +45,189 @@ class State(TypedDict):
     messages: Annotated[list, add_messages]
     result_flag: bool
     stop_flag: bool
+    path: list
+    current_step: int
+    vote: int
+    hop_prompt: Union[tuple, NoneType]
+    evaluation_mode: str
+
+
+def get_run_context(config, key):
+    """
+    Returns an object shared by all the nodes of a single evaluation (e.g., the path trie), passed in the run config.
+    """
+    return config.get("configurable", {}).get(key) if config is not None else None
 
 
 class ChatbotNode:
-    def __init__(self, llm):
+    def __init__(self, llm, context_policy=None, on_llm_call=None):
         self.llm = llm
-
-    def __call__(self, state: State):
-        return {"messages": [self.llm.invoke(state["messages"])], "result_flag": False, "stop_flag": False}
+        self.context_policy = context_policy
+        self.on_llm_call = on_llm_call
+
+    def __get_context(self, state):
+        if self.context_policy is None:
+            return state["messages"]
+        return self.context_policy.trim_messages(state["messages"], state["path"])
+
+    def __report_llm_call(self, context, reply, latency):
+        usage_metadata = getattr(reply, "usage_metadata", None) or {}
+        input_tokens_num = usage_metadata.get("input_tokens", ContextPolicy.estimate_tokens_num(context))
+        output_tokens_num = usage_metadata.get("output_tokens", ContextPolicy.estimate_tokens_num([reply]))
+        metrics.observe("llm.call", latency)
+        metrics.increment("llm.calls")
+        metrics.increment("llm.input_tokens", input_tokens_num)
+        metrics.increment("llm.output_tokens", output_tokens_num)
+        if self.on_llm_call is not None:
+            self.on_llm_call(input_tokens_num)
+
+    def __call__(self, state: State, config: RunnableConfig):
+        context = self.__get_context(state)
+        start_time = time.perf_counter()
+        reply = self.llm.invoke(context)
+        self.__report_llm_call(context, reply, time.perf_counter() - start_time)
+        return {"messages": [reply]}
+
+    async def acall(self, state: State, config: RunnableConfig):
+        context = self.__get_context(state)
+        semaphore = get_run_context(config, "llm_semaphore")
+        if semaphore is None:
+            start_time = time.perf_counter()
+            reply = await self.llm.ainvoke(context)
+        else:
+            # the semaphore bounds the number of concurrent requests to the LLM backend
+            async with semaphore:
+                start_time = time.perf_counter()
+                reply = await self.llm.ainvoke(context)
+        self.__report_llm_call(context, reply, time.perf_counter() - start_time)
+        return {"messages": [reply]}
 
 
 class PathLogicNode:
-    def __init__(self, afunc, path, prompt_generator):
-        self.afunc = afunc
-        self.path = path
+    """
+    Drives the hop-by-hop evaluation of a path. The node itself is stateless: the path, the current step and the
+    current hop prompt are kept in the graph state, so a single compiled graph can evaluate any number of paths,
+    concurrently as well.
+    The hops which the static hop analyzer (if any) can decide on its own are not sent to the LLM.
+    In the path evaluation mode all the remaining hops are asked about in a single prompt. If the reply cannot be
+    parsed, the evaluation falls back to one prompt per hop.
+    """
+    def __init__(self, prompt_generator, hop_analyzer=None):
         self.prompt_generator = prompt_generator
-        self.current_step = 0
+        self.hop_analyzer = hop_analyzer
+
+    def __get_decided_hop_verdict(self, path_trie, path, current_step, vote):
+        if path_trie is not None:
+            hop_verdict = path_trie.get_hop_verdict(path, current_step, vote)
+            if hop_verdict is not None:
+                metrics.increment("hops.replayed")
+                return hop_verdict
+        if self.hop_analyzer is not None:
+            yes_or_no = self.hop_analyzer.classify_hop(path, current_step)
+            if yes_or_no is not None:
+                metrics.increment("hops.decided_statically")
+                # keep one prompt per hop in the conversation, so that the LLM still sees the whole call chain
+                hop_verdict = (yes_or_no, [("user", self.prompt_generator.create_static_hop_prompt(path, current_step)),
+                                           ("assistant", "Yes" if yes_or_no == 'y' else "No")])
+                if path_trie is not None:
+                    # the other paths through this hop replay the verdict instead of classifying the hop again
+                    path_trie.set_hop_verdict(path, current_step, vote, *hop_verdict, persist=False)
+                return hop_verdict
+        return None
+
+    def __replay_decided_hops(self, path_trie, path, current_step, vote):
+        """
+        Skips the hops already decided by other paths sharing the same prefix in the current vote, or by the static
+        hop analyzer.
+        Returns the messages exchanged for the skipped hops, the new current step and the final result if the path
+        got decided.
+        """
+        replayed_messages = []
+        while True:
+            hop_verdict = self.__get_decided_hop_verdict(path_trie, path, current_step, vote)
+            if hop_verdict is None:
+                break
+            yes_or_no, hop_messages = hop_verdict
+            if yes_or_no == 'n':
+                return replayed_messages, current_step, False
+            replayed_messages.extend(hop_messages)
+            current_step += 1
+            if current_step == len(path) - 1:
+                return replayed_messages, current_step, True
+        return replayed_messages, current_step, None
+
+    def __create_next_prompt(self, state, current_step, path_trie, evaluation_mode=None):
+        path = state["path"]
+        replayed_messages, current_step, result = self.__replay_decided_hops(path_trie, path, current_step,
+                                                                             state["vote"])
+        if result is not None:
+            return {"messages": replayed_messages, "result_flag": result, "stop_flag": True,
+                    "current_step": current_step}
+
+        metrics.increment("hops.asked")
+        if (evaluation_mode or state["evaluation_mode"]) == PATH_EVALUATION:
+            hop_prompt = ("user", self.prompt_generator.create_path_prompt(path, current_step))
+        elif len(state["messages"]) == 0 and current_step == 0:
+            hop_prompt = ("user", self.prompt_generator.create_initial_prompt(path, current_step))
+        else:
+            hop_prompt = ("user", self.prompt_generator.create_prompt(path, current_step))
+        return {"messages": replayed_messages + [hop_prompt], "result_flag": False, "stop_flag": False,
+                "current_step": current_step, "hop_prompt": hop_prompt}
 
-    def __call__(self, inputs):
-        messages = inputs["messages"]
+    def __call__(self, state: State, config: RunnableConfig):
+        path_trie = get_run_context(config, "path_trie")
+        messages = state["messages"]
         if len(messages) == 0:
             # this is the very first call, just create the initial prompt and exit
-            output = self.prompt_generator.create_initial_prompt(self.path, self.current_step)
-            return {"messages": [("user", output)], "result_flag": False, "stop_flag": False}
+            return self.__create_next_prompt(state, state["current_step"], path_trie)
 
         # Analyze the reply - there are three cases:
         # 1) The current step answer is 'Yes' and there are more steps to be taken;
         # 2) The current step answer is 'Yes' and this is the last step;
         # 3) The current step answer is 'No'.
+        path = state["path"]
+        current_step = state["current_step"]
         reply = messages[-1]
+        if state["evaluation_mode"] == PATH_EVALUATION:
+            return self.__analyze_path_reply(state, reply, path_trie)
+
         yes_or_no = self.prompt_generator.analyze_llm_reply(reply)
-        if yes_or_no == 'n':
-            return {"messages": [], "result_flag": False, "stop_flag": True}
-        elif yes_or_no == 'y':
-            self.current_step += 1
-            if self.current_step == len(self.path) - 1:
-                return {"messages": [], "result_flag": True, "stop_flag": True}
-        else:
+        if yes_or_no not in ('y', 'n'):
             raise ValueError(f"Unexpected reply from LLM: {reply}")
+        if path_trie is not None:
+            path_trie.set_hop_verdict(path, current_step, state["vote"], yes_or_no, [state["hop_prompt"], reply])
 
-        output = self.prompt_generator.create_prompt(self.path, self.current_step)
-
-        return {"messages": [("user", output)], "result_flag": False, "stop_flag": False}
+        if yes_or_no == 'n':
+            return {"result_flag": False, "stop_flag": True}
+        current_step += 1
+        if current_step == len(path) - 1:
+            return {"result_flag": True, "stop_flag": True, "current_step": current_step}
+
+        return self.__create_next_prompt(state, current_step, path_trie)
+
+    def __analyze_path_reply(self, state, reply, path_trie):
+        path = state["path"]
+        current_step = state["current_step"]
+        hop_verdicts = self.prompt_generator.analyze_path_reply(reply, len(path) - 1 - current_step)
+        if hop_verdicts is None:
+            # drop the unparsable exchange (including any tool calls) from the conversation and ask hop by hop
+            messages = state["messages"]
+            path_prompt_index = max(i for i, message in enumerate(messages) if isinstance(message, HumanMessage))
+            update = self.__create_next_prompt(state, current_step, path_trie, HOP_EVALUATION)
+            update["messages"] = [RemoveMessage(id=message.id) for message in messages[path_prompt_index:]] + \
+                update["messages"]
+            update["evaluation_mode"] = HOP_EVALUATION
+            return update
+
+        for step, yes_or_no in enumerate(hop_verdicts, start=current_step):
+            if path_trie is not None:
+                # the verdicts are recorded per hop, so that the paths sharing a prefix with this one can replay them
+                hop_messages = [("user", self.prompt_generator.create_static_hop_prompt(path, step)),
+                                AIMessage(content="Yes" if yes_or_no == 'y' else "No")]
+                path_trie.set_hop_verdict(path, step, state["vote"], yes_or_no, hop_messages)
+            if yes_or_no == 'n':
+                return {"result_flag": False, "stop_flag": True, "current_step": step}
+        return {"result_flag": True, "stop_flag": True, "current_step": len(path) - 1}
 
 
 class ToolNode:
@@ -84,9 +241,11 @@ class ToolNode:
             raise ValueError("No message found in input")
         outputs = []
         for tool_call in message.tool_calls:
-            tool_result = self.tools_by_name[tool_call["name"]].invoke(
-                tool_call["args"]
-            )
+            metrics.increment("tools.calls")
+            with metrics.timed("tools.call"):
+                tool_result = self.tools_by_name[tool_call["name"]].invoke(
+                    tool_call["args"]
+                )
             outputs.append(
                 ToolMessage(
                     content=json.dumps(tool_result),
@@ -100,25 +259,71 @@ class ToolNode:
 class PathEvaluator(object):
 
     MAJORITY_VOTE_NUM = 3
-
-    def __init__(self, llm, prompt_generator):
+    DEFAULT_MAX_CONCURRENCY = 8
+    # the number of paths produced ahead of the evaluation, per test and overall, in the lazy evaluation
+    MAX_QUEUED_PATHS_PER_TEST = 4
+    MAX_QUEUED_PATHS = 64
+    # the number of produced paths of a test among which the cheapest is evaluated next, in the lazy evaluation
+    MAX_REORDERED_PATHS_PER_TEST = 16
+
+    def __init__(self, llm, prompt_generator, max_concurrency=DEFAULT_MAX_CONCURRENCY, voting_strategy=None,
+                 verdict_cache=None, hop_analyzer=None, evaluation_mode=HOP_EVALUATION):
         self.__llm = llm
+        self.__model_name = get_model_name(llm)
         self.__prompt_generator = prompt_generator
+        self.__verdict_cache = verdict_cache
+        self.__hop_analyzer = hop_analyzer
+        self.__path_scheduler = PathScheduler(prompt_generator.code_retriever)
+        if evaluation_mode not in (HOP_EVALUATION, PATH_EVALUATION):
+            raise ValueError(f"Unknown evaluation mode '{evaluation_mode}', "
+                             f"expected '{HOP_EVALUATION}' or '{PATH_EVALUATION}'.")
+        self.__evaluation_mode = evaluation_mode
+        self.__max_concurrency = max_concurrency
+        self.__llm_semaphore = None
+        self.__default_voting_strategy = voting_strategy or VotingStrategy(vote_num=self.MAJORITY_VOTE_NUM)
+        self.__voting_strategy = self.__default_voting_strategy
 
         self.__tools = self._create_tools()
         if ENABLE_CODE_EXTRACT_TOOL:
             self.__prompt_generator.tool_use_enabled = True
             self.__llm = llm.bind_tools(self.__tools)
 
-        self.__afunc = None
-        self.__paths = []
+        self.__path_trie = None
         self.__tests_to_run = []
-
-    def __create_state_graph(self, path):
+        self.__accepted_paths = []
+        self.__paths_total_num = 0
+        self.__paths_remaining_num = 0
+        self.llm_calls_num = 0
+        self.prompt_tokens_num = 0
+
+        # a single compiled graph serves all the runs, as all the per-run data is kept in the graph state
+        with metrics.timed("state_graph.compile"):
+            self.__state_graph = self.__create_state_graph()
+
+    @property
+    def llm_calls_avoided(self):
+        return self.__hop_analyzer.llm_calls_avoided if self.__hop_analyzer is not None else 0
+
+    def __reset_stats(self):
+        self.llm_calls_num = 0
+        self.prompt_tokens_num = 0
+        if self.__hop_analyzer is not None:
+            self.__hop_analyzer.reset_stats()
+
+    def get_stats(self):
+        return {"llm_calls": self.llm_calls_num, "prompt_tokens": self.prompt_tokens_num,
+                "llm_calls_avoided": self.llm_calls_avoided}
+
+    def __count_llm_call(self, prompt_tokens_num):
+        self.llm_calls_num += 1
+        self.prompt_tokens_num += prompt_tokens_num
+
+    def __create_state_graph(self):
         graph_builder = StateGraph(State)
 
-        graph_builder.add_node("chatbot", ChatbotNode(self.__llm))
-        graph_builder.add_node("path_logic", PathLogicNode(self.__afunc, path, self.__prompt_generator))
+        chatbot_node = ChatbotNode(self.__llm, self.__prompt_generator.context_policy, self.__count_llm_call)
+        graph_builder.add_node("chatbot", RunnableLambda(chatbot_node, afunc=chatbot_node.acall))
+        graph_builder.add_node("path_logic", PathLogicNode(self.__prompt_generator, self.__hop_analyzer))
         graph_builder.add_node("tools", ToolNode(tools=self.__tools))
 
         graph_builder.add_edge(START, "path_logic")
@@ -140,6 +345,15 @@ class PathEvaluator(object):
 
         return graph_builder.compile()
 
+    def __get_verdict_cache_key(self, path, step, vote):
+        return VerdictCache.create_key(self.__model_name, self.__evaluation_mode, vote,
+                                       *self.__prompt_generator.get_hop_fingerprint(path, step))
+
+    def __create_path_trie(self, paths, use_verdict_cache):
+        if use_verdict_cache and self.__verdict_cache is not None:
+            return PathTrie(paths, self.__verdict_cache, self.__get_verdict_cache_key)
+        return PathTrie(paths)
+
     @staticmethod
     def route_tools(state: State):
         """
@@ -185,43 +399,362 @@ class PathEvaluator(object):
                                            output_format=output_format)
         return [code_extract_tool]
 
-    def __run_single_state_graph(self, path):
-        state_graph = self.__create_state_graph(path)
-        initial_state = {"messages": [], "result_flag": False, "stop_flag": False}
-        result = state_graph.invoke(initial_state)
+    def __run_single_state_graph(self, path, vote):
+        if self.__path_trie.is_rejected(path, vote):
+            # a hop on this path was already rejected in this vote - no need to ask the LLM again
+            return False
+        initial_state = self.__create_initial_state(path, vote)
+        try:
+            result = self.__state_graph.invoke(initial_state, self.__get_run_config(path))
+        except GraphRecursionError:
+            # the run did not converge within the allowed number of steps - let's be safe and assume a positive reply
+            return True
         return result["result_flag"]
 
-    def __evaluate_next_path(self):
-        current_path = self.__paths.pop(0)
-        current_test = current_path[0]
-        if current_test in self.__tests_to_run:
-            # already added - no need to evaluate this path
-            return
+    def __create_initial_state(self, path, vote):
+        return {"messages": [], "result_flag": False, "stop_flag": False, "path": path, "current_step": 0,
+                "vote": vote, "hop_prompt": None, "evaluation_mode": self.__evaluation_mode}
+
+    def __get_run_config(self, path):
+        return {"recursion_limit": self.__voting_strategy.get_recursion_limit(path),
+                "configurable": {"path_trie": self.__path_trie, "llm_semaphore": self.__llm_semaphore}}
 
+    def __evaluate_path(self, current_path):
         positive_replies_num = 0
         negative_replies_num = 0
-        for _ in range(self.MAJORITY_VOTE_NUM):
-            current_result = self.__run_single_state_graph(current_path)
+        decision = None
+        for vote in range(self.__voting_strategy.vote_num):
+            current_result = self.__run_single_state_graph(current_path, vote)
             if current_result:
                 positive_replies_num += 1
             else:
                 negative_replies_num += 1
-        if positive_replies_num > negative_replies_num:
-            self.__tests_to_run.append(current_test)
+            decision = self.__voting_strategy.get_decision(positive_replies_num, negative_replies_num)
+            if decision is not None:
+                # the outcome cannot change anymore - no need for the remaining votes
+                break
+        if decision:
+            self.__tests_to_run.append(current_path[0])
+            self.__accepted_paths.append(current_path)
+        return decision
+
+    async def __arun_single_state_graph(self, path, vote):
+        if self.__path_trie.is_rejected(path, vote):
+            return False
+        initial_state = self.__create_initial_state(path, vote)
+        try:
+            result = await self.__state_graph.ainvoke(initial_state, self.__get_run_config(path))
+        except GraphRecursionError:
+            return True
+        return result["result_flag"]
 
-    def evaluate_paths(self, afunc, paths):
+    async def __aevaluate_path(self, current_path):
+        # up to parallel_votes votes are run speculatively and the rest are cancelled once the outcome is decided
+        strategy = self.__voting_strategy
+        pending_votes = set()
+        next_vote = 0
+        positive_replies_num = 0
+        negative_replies_num = 0
+        try:
+            while True:
+                while next_vote < strategy.vote_num and len(pending_votes) < strategy.parallel_votes:
+                    pending_votes.add(asyncio.ensure_future(self.__arun_single_state_graph(current_path, next_vote)))
+                    next_vote += 1
+                done_votes, pending_votes = await asyncio.wait(pending_votes, return_when=asyncio.FIRST_COMPLETED)
+                for done_vote in done_votes:
+                    if done_vote.result():
+                        positive_replies_num += 1
+                    else:
+                        negative_replies_num += 1
+                decision = strategy.get_decision(positive_replies_num, negative_replies_num)
+                if decision is not None:
+                    return decision
+        finally:
+            for pending_vote in pending_votes:
+                pending_vote.cancel()
+            await asyncio.gather(*pending_votes, return_exceptions=True)
+
+    async def __aevaluate_test_paths(self, test_paths, event_queue=None):
+        # paths of the same test are evaluated one after another, the cheapest first, so that they can reuse the
+        # verdicts on their shared prefixes and so that the remaining paths are skipped as soon as the test is selected
+        for path_index, path in enumerate(test_paths):
+            accepted = await self.__aevaluate_path(path)
+            self.__paths_remaining_num -= len(test_paths) - path_index if accepted else 1
+            if event_queue is not None:
+                if accepted:
+                    event_queue.put_nowait({"event": "test_selected", "test": str(path[0]),
+                                            "path": [str(afunc) for afunc in path]})
+                event_queue.put_nowait(self.__create_progress_event())
+            if accepted:
+                return path
+        return None
+
+    def __create_progress_event(self):
+        return {"event": "progress", "paths_total": self.__paths_total_num,
+                "paths_remaining": self.__paths_remaining_num, **self.get_stats()}
+
+    def evaluate_paths(self, afunc, paths, voting_strategy=None, use_verdict_cache=True):
+        """
+        Returns the tests having a path to the target accepted by the majority vote.
+        The paths are evaluated test by test, the cheapest ones first (see PathScheduler), and the remaining paths of
+        a test are skipped once one of them is accepted.
+        """
         if len(paths) == 0:
             raise Exception("No valid paths to target function were found, no work to be done.")
 
-        self.__afunc = afunc
-        self.__paths = paths
+        self.__voting_strategy = voting_strategy or self.__default_voting_strategy
+        self.__path_trie = self.__create_path_trie(paths, use_verdict_cache)
         self.__tests_to_run = []
+        self.__accepted_paths = []
+        self.__reset_stats()
+
+        for test_paths in self.__path_scheduler.schedule(self.__path_trie):
+            for path in test_paths:
+                if self.__evaluate_path(path):
+                    # the test is selected - no need to evaluate its remaining (costlier) paths
+                    break
+
+        return self.__tests_to_run
 
-        while len(paths) > 0:
-            self.__evaluate_next_path()
+    async def aevaluate_paths(self, afunc, paths, voting_strategy=None, use_verdict_cache=True):
+        """
+        The asynchronous counterpart of evaluate_paths.
+        The paths of different tests and the votes on each path are evaluated concurrently, while the number of
+        simultaneous LLM requests is bounded by max_concurrency. The tests are returned in the same order as
+        evaluate_paths would return them.
+        """
+        async for _ in self.astream_paths(afunc, paths, voting_strategy, use_verdict_cache, progress_events=False):
+            pass
+        return self.__tests_to_run
+
+    async def astream_paths(self, afunc, paths, voting_strategy=None, use_verdict_cache=True, progress_events=True):
+        """
+        Evaluates the paths like aevaluate_paths, yielding events as the evaluation proceeds:
+        - {"event": "test_selected", "test": ..., "path": [...]} as soon as the majority for a test is decided;
+        - {"event": "progress", "paths_total": ..., "paths_remaining": ..., **get_stats()} after every path;
+        - {"event": "done", "tests_to_run": [...], **get_stats()} at the end, with the tests in a stable order.
+        """
+        if len(paths) == 0:
+            raise Exception("No valid paths to target function were found, no work to be done.")
 
+        self.__voting_strategy = voting_strategy or self.__default_voting_strategy
+        self.__path_trie = self.__create_path_trie(paths, use_verdict_cache)
+        self.__llm_semaphore = asyncio.Semaphore(self.__max_concurrency)
+        self.__paths_total_num = self.__paths_remaining_num = len(self.__path_trie)
+        self.__reset_stats()
+
+        event_queue = asyncio.Queue()
+        test_tasks = [asyncio.ensure_future(self.__aevaluate_test_paths(test_paths, event_queue))
+                      for test_paths in self.__path_scheduler.schedule(self.__path_trie)]
+        all_tests_task = asyncio.gather(*test_tasks)
+        try:
+            while not (all_tests_task.done() and event_queue.empty()):
+                next_event_task = asyncio.ensure_future(event_queue.get())
+                done_tasks, _ = await asyncio.wait({next_event_task, all_tests_task},
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if next_event_task not in done_tasks:
+                    next_event_task.cancel()
+                    continue
+                event = next_event_task.result()
+                if progress_events or event["event"] != "progress":
+                    yield event
+
+            self.__accepted_paths = [accepted_path for accepted_path in all_tests_task.result()
+                                     if accepted_path is not None]
+            self.__tests_to_run = [accepted_path[0] for accepted_path in self.__accepted_paths]
+            yield {"event": "done", "tests_to_run": [str(t) for t in self.__tests_to_run], **self.get_stats()}
+        finally:
+            # the consumer may stop early, in which case the pending evaluations are no longer needed
+            for test_task in test_tasks:
+                test_task.cancel()
+            await asyncio.gather(*test_tasks, return_exceptions=True)
+            self.__llm_semaphore = None
+
+    def __produce_lazy_paths(self, enumerate_paths, path_queue, loop, stop_event, selected_tests):
+        """
+        Runs in a worker thread and feeds the paths produced by enumerate_paths into path_queue, blocking while the
+        queue is full. None marks the end of the paths.
+        """
+        def skip_test(test):
+            return stop_event.is_set() or test in selected_tests
+
+        try:
+            for path in enumerate_paths(skip_test):
+                if stop_event.is_set():
+                    break
+                asyncio.run_coroutine_threadsafe(path_queue.put(path), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(path_queue.put(None), loop)
+
+    async def __aevaluate_queued_test_paths(self, test_queue, event_queue, selected_tests, active_tests_semaphore):
+        """
+        Evaluates the paths of a single test as they arrive in test_queue, until None is received. The paths are
+        evaluated in the order of PathScheduler, within a window of up to MAX_REORDERED_PATHS_PER_TEST paths produced
+        and not evaluated yet. Once the test is selected, its remaining paths are dropped.
+        """
+        accepted_path = None
+        pending_paths = []
+        enumeration_done = False
+        try:
+            while True:
+                # take in the paths produced in the meantime, waiting for one only if there is none to evaluate
+                while not enumeration_done and len(pending_paths) < self.MAX_REORDERED_PATHS_PER_TEST and \
+                        (len(pending_paths) == 0 or not test_queue.empty()):
+                    path = await test_queue.get()
+                    if path is None:
+                        enumeration_done = True
+                    else:
+                        # the paths of a single test are distinct, so their node names always break the ties
+                        heapq.heappush(pending_paths, (*self.__path_scheduler.get_sort_key(path), path))
+                if len(pending_paths) == 0:
+                    break
+                path = heapq.heappop(pending_paths)[-1]
+                if accepted_path is not None:
+                    self.__paths_remaining_num -= 1
+                    continue
+                if await self.__aevaluate_path(path):
+                    accepted_path = path
+                    selected_tests.add(path[0])
+                    event_queue.put_nowait({"event": "test_selected", "test": str(path[0]),
+                                            "path": [str(afunc) for afunc in path]})
+                self.__paths_remaining_num -= 1
+                event_queue.put_nowait(self.__create_progress_event())
+            return accepted_path
+        finally:
+            active_tests_semaphore.release()
+
+    async def __dispatch_lazy_paths(self, path_queue, event_queue, selected_tests, test_tasks):
+        """
+        Distributes the produced paths to one evaluation task per test. At most max_concurrency tests are evaluated
+        at the same time, which bounds the number of paths held in memory.
+        """
+        active_tests_semaphore = asyncio.Semaphore(self.__max_concurrency)
+        test_queue = None
+        while (path := await path_queue.get()) is not None:
+            self.__paths_total_num += 1
+            self.__paths_remaining_num += 1
+            if test_queue is None or path[0] != current_test:
+                if test_queue is not None:
+                    await test_queue.put(None)
+                await active_tests_semaphore.acquire()
+                current_test = path[0]
+                test_queue = asyncio.Queue(maxsize=self.MAX_QUEUED_PATHS_PER_TEST)
+                test_tasks.append(asyncio.ensure_future(self.__aevaluate_queued_test_paths(
+                    test_queue, event_queue, selected_tests, active_tests_semaphore)))
+            await test_queue.put(path)
+        if test_queue is not None:
+            await test_queue.put(None)
+        return await asyncio.gather(*test_tasks)
+
+    async def astream_lazy_paths(self, afunc, enumerate_paths, voting_strategy=None, use_verdict_cache=True,
+                                 progress_events=True):
+        """
+        Like astream_paths, but the paths are consumed while enumerate_paths(skip_test) produces them (e.g., by
+        CallGraphCreator.iter_test_paths), so the evaluation overlaps the graph traversal and only a bounded number
+        of paths is held in memory at any time. enumerate_paths runs in a worker thread, must produce the paths of
+        every test one after another and should stop producing the paths of a test once skip_test(test) returns
+        True, which happens as soon as the test is selected.
+        The tests are evaluated in the order they are produced. The paths of a test are evaluated cheapest first
+        among the paths produced so far (see MAX_REORDERED_PATHS_PER_TEST), and the paths_total of the progress events
+        only counts the paths produced so far.
+        """
+        self.__voting_strategy = voting_strategy or self.__default_voting_strategy
+        # the paths are not inserted into the trie, it only keeps the verdicts on the hops
+        self.__path_trie = self.__create_path_trie([], use_verdict_cache)
+        self.__llm_semaphore = asyncio.Semaphore(self.__max_concurrency)
+        self.__paths_total_num = self.__paths_remaining_num = 0
+        self.__reset_stats()
+
+        path_queue = asyncio.Queue(maxsize=self.MAX_QUEUED_PATHS)
+        event_queue = asyncio.Queue()
+        stop_event = threading.Event()
+        selected_tests = set()
+        test_tasks = []
+        producer_task = asyncio.ensure_future(asyncio.to_thread(
+            self.__produce_lazy_paths, enumerate_paths, path_queue, asyncio.get_running_loop(), stop_event,
+            selected_tests))
+        dispatcher_task = asyncio.ensure_future(self.__dispatch_lazy_paths(path_queue, event_queue, selected_tests,
+                                                                           test_tasks))
+        try:
+            while not (dispatcher_task.done() and event_queue.empty()):
+                next_event_task = asyncio.ensure_future(event_queue.get())
+                done_tasks, _ = await asyncio.wait({next_event_task, dispatcher_task},
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if next_event_task not in done_tasks:
+                    next_event_task.cancel()
+                    continue
+                event = next_event_task.result()
+                if progress_events or event["event"] != "progress":
+                    yield event
+
+            # surface the errors of the enumeration
+            await producer_task
+            self.__accepted_paths = [accepted_path for accepted_path in dispatcher_task.result()
+                                     if accepted_path is not None]
+            self.__tests_to_run = [accepted_path[0] for accepted_path in self.__accepted_paths]
+            yield {"event": "done", "tests_to_run": [str(t) for t in self.__tests_to_run], **self.get_stats()}
+        finally:
+            stop_event.set()
+            for task in [dispatcher_task, *test_tasks]:
+                task.cancel()
+            await asyncio.gather(dispatcher_task, *test_tasks, return_exceptions=True)
+            # unblock the producer if it waits for room in the queue
+            while not producer_task.done():
+                while not path_queue.empty():
+                    path_queue.get_nowait()
+                await asyncio.wait({producer_task}, timeout=0.01)
+            self.__llm_semaphore = None
+
+    async def aevaluate_lazy_paths(self, afunc, enumerate_paths, voting_strategy=None, use_verdict_cache=True):
+        """
+        The non-streaming counterpart of astream_lazy_paths.
+        """
+        async for _ in self.astream_lazy_paths(afunc, enumerate_paths, voting_strategy, use_verdict_cache,
+                                               progress_events=False):
+            pass
         return self.__tests_to_run
 
+    def __group_tests_by_target(self, target_paths):
+        """
+        Returns a dictionary from the target node names to a dictionary holding the tests selected for this target
+        and the tests reaching this target which were not evaluated for it because another target selected them.
+        """
+        tests_by_target = {afunc.node_name: {"selected": [], "selected_for_other_targets": []} for afunc, _ in target_paths}
+        selecting_targets = {}
+        for accepted_path in self.__accepted_paths:
+            tests_by_target[accepted_path[-1].node_name]["selected"].append(accepted_path[0])
+            selecting_targets[accepted_path[0]] = accepted_path[-1]
+        for target, paths in target_paths:
+            for test in dict.fromkeys(path[0] for path in paths):
+                if selecting_targets.get(test, target) != target:
+                    tests_by_target[target.node_name]["selected_for_other_targets"].append(test)
+        return tests_by_target
+
+    def evaluate_targets(self, target_paths, voting_strategy=None, use_verdict_cache=True):
+        """
+        Evaluates the paths leading to several target functions in a single pass.
+        target_paths is a list of (target function, paths) pairs. The paths of all the targets are merged into one
+        path trie, so they are deduplicated and share the hop verdicts. A test selected for one target is not
+        evaluated again for the others.
+        Returns a dictionary from the target node names to the tests selected for them (see __group_tests_by_target),
+        and the combined list of selected tests.
+        """
+        paths = [path for _, paths in target_paths for path in paths]
+        if len(paths) == 0:
+            return self.__group_tests_by_target(target_paths), []
+        tests_to_run = self.evaluate_paths(None, paths, voting_strategy, use_verdict_cache)
+        return self.__group_tests_by_target(target_paths), tests_to_run
+
+    async def aevaluate_targets(self, target_paths, voting_strategy=None, use_verdict_cache=True):
+        """
+        The asynchronous counterpart of evaluate_targets.
+        """
+        paths = [path for _, paths in target_paths for path in paths]
+        if len(paths) == 0:
+            return self.__group_tests_by_target(target_paths), []
+        tests_to_run = await self.aevaluate_paths(None, paths, voting_strategy, use_verdict_cache)
+        return self.__group_tests_by_target(target_paths), tests_to_run
+
 
 if __name__ == "__main__":
     target_function = AFunc(function_name="ensure_type", class_name=None, module_name="manager")
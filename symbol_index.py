@@ -0,0 +1,116 @@
+import ast
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def index_module_symbols(module_path):
+    """
+    Parses the given module and returns a dictionary mapping (class_name, function_name) to the list of line spans
+    (first line, last line) of the decorators and the body of the function or method.
+    class_name is None for functions. Methods of nested classes are registered under both the innermost class name
+    and the dotted path of the class (e.g., 'Outer.Inner').
+    As a function name alone (class_name None) the first definition in breadth-first order is registered, be it a
+    module-level function, a method or a nested function.
+    The modules which cannot be read or parsed (e.g., Python 2 modules or test data files) have no symbols.
+    """
+    try:
+        with open(module_path, 'r') as f:
+            module_ast = ast.parse(f.read())
+    except (SyntaxError, UnicodeDecodeError, ValueError):
+        return {}
+
+    symbols = {}
+    # the queue holds the nodes to visit along with their dotted class path (None for nodes which are not classes)
+    queue = deque([(module_ast, None)])
+    while len(queue) > 0:
+        node, class_path = queue.popleft()
+        for child in ast.iter_child_nodes(node):
+            child_class_path = None
+            if isinstance(child, ast.ClassDef):
+                child_class_path = child.name if class_path is None else f"{class_path}.{child.name}"
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                spans = [(d.lineno, d.end_lineno) for d in child.decorator_list] + [(child.lineno, child.end_lineno)]
+                symbols.setdefault((None, child.name), spans)
+                if class_path is not None:
+                    symbols.setdefault((node.name, child.name), spans)
+                    symbols.setdefault((class_path, child.name), spans)
+            queue.append((child, child_class_path))
+    return symbols
+
+
+class SymbolIndex(object):
+    """
+    An index of the Python modules under a root directory and of the functions and methods defined in them.
+    The modules are indexed lazily on first access (or all at once, in parallel, by build()) and are re-indexed
+    whenever their modification time changes.
+    """
+    def __init__(self, root_dir):
+        self.__root_dir = root_dir
+        self.__module_paths = None
+        self.__module_symbols = {}
+
+    def __scan_module_paths(self):
+        module_paths = {}
+        for dir_path, _, files in os.walk(self.__root_dir):
+            for file_name in files:
+                if not file_name.endswith(".py"):
+                    continue
+                module_path = os.path.join(dir_path, file_name)
+                module_name = file_name[:-len(".py")]
+                relative_module_name = os.path.relpath(module_path, self.__root_dir)[:-len(".py")]
+                # the first module found wins, just like with a plain directory walk
+                module_paths.setdefault(module_name, module_path)
+                module_paths.setdefault(relative_module_name.replace(os.sep, "."), module_path)
+        return module_paths
+
+    def __get_module_paths(self):
+        if self.__module_paths is None:
+            self.__module_paths = self.__scan_module_paths()
+        return self.__module_paths
+
+    def find_module_path(self, module_name):
+        return self.__get_module_paths().get(module_name)
+
+    def get_module_symbols(self, module_path):
+        mtime = os.stat(module_path).st_mtime_ns
+        indexed_module = self.__module_symbols.get(module_path)
+        if indexed_module is None or indexed_module[0] != mtime:
+            indexed_module = (mtime, index_module_symbols(module_path))
+            self.__module_symbols[module_path] = indexed_module
+        return indexed_module[1]
+
+    def find_symbol(self, module_name, class_name, function_name):
+        """
+        Returns a tuple (module_path, spans) for the given function or method, or None if the module is unknown.
+        spans is None if the module does not define the given function or method.
+        """
+        module_path = self.find_module_path(module_name)
+        if module_path is None:
+            return None
+        return module_path, self.get_module_symbols(module_path).get((class_name, function_name))
+
+    def build(self, max_workers=None):
+        """
+        Indexes all the modules that are new or were modified since they were last indexed, parsing them in parallel.
+        """
+        module_paths = set(self.__get_module_paths().values())
+        mtimes = {module_path: os.stat(module_path).st_mtime_ns for module_path in module_paths}
+        stale_module_paths = [module_path for module_path in module_paths
+                              if self.__module_symbols.get(module_path, (None,))[0] != mtimes[module_path]]
+        if len(stale_module_paths) == 0:
+            return
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for module_path, symbols in zip(stale_module_paths, executor.map(index_module_symbols, stale_module_paths)):
+                self.__module_symbols[module_path] = (mtimes[module_path], symbols)
+
+    def refresh(self, max_workers=None):
+        """
+        Rescans the root directory for added or removed modules and re-indexes the modified ones.
+        """
+        self.__module_paths = self.__scan_module_paths()
+        module_paths = set(self.__module_paths.values())
+        for module_path in list(self.__module_symbols.keys()):
+            if module_path not in module_paths:
+                del self.__module_symbols[module_path]
+        self.build(max_workers)
@@ -0,0 +1,47 @@
+import os
+
+from ast_call_graph import AstCallGraphCreator
+
+
+def create_modules(code_dir):
+    code_dir.mkdir()
+    (code_dir / "app.py").write_text("from gone import g\n\n\ndef f():\n    g()\n")
+    (code_dir / "gone.py").write_text("def g():\n    pass\n")
+
+
+def test_snapshot_is_not_reused_once_a_module_is_deleted(tmp_path):
+    code_dir = tmp_path / "src"
+    create_modules(code_dir)
+    snapshot_path = str(tmp_path / "graph.snap")
+    graph = AstCallGraphCreator(source_dir=str(code_dir), snapshot_path=snapshot_path, max_workers=1).get_graph()
+    assert "gone::g" in graph.node_names
+
+    # none of the remaining modules is newer than the snapshot
+    os.remove(code_dir / "gone.py")
+    graph = AstCallGraphCreator(source_dir=str(code_dir), snapshot_path=snapshot_path, max_workers=1).get_graph()
+    assert "gone::g" not in graph.node_names
+    assert "app::f" in graph.node_names
+
+
+def test_snapshot_is_reused_while_the_modules_are_unchanged(tmp_path):
+    code_dir = tmp_path / "src"
+    create_modules(code_dir)
+    snapshot_path = str(tmp_path / "graph.snap")
+    AstCallGraphCreator(source_dir=str(code_dir), snapshot_path=snapshot_path, max_workers=1).get_graph()
+    snapshot_mtime_ns = os.stat(snapshot_path).st_mtime_ns
+
+    graph = AstCallGraphCreator(source_dir=str(code_dir), snapshot_path=snapshot_path, max_workers=1).get_graph()
+    assert os.stat(snapshot_path).st_mtime_ns == snapshot_mtime_ns
+    assert sorted(graph.get_named_edges()) == [("app::f", "gone::g")]
+
+
+def test_incremental_graph_forgets_the_deleted_modules(tmp_path):
+    code_dir = tmp_path / "src"
+    create_modules(code_dir)
+    snapshot_path, state_path = str(tmp_path / "graph.snap"), str(tmp_path / "state.json")
+    AstCallGraphCreator(source_dir=str(code_dir), snapshot_path=snapshot_path, state_path=state_path).get_graph()
+
+    os.remove(code_dir / "gone.py")
+    graph = AstCallGraphCreator(source_dir=str(code_dir), snapshot_path=snapshot_path,
+                                state_path=state_path).get_graph()
+    assert "gone::g" not in graph.node_names
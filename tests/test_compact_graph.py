@@ -0,0 +1,24 @@
+from compact_graph import CompactCallGraph
+
+
+def test_saved_snapshot_is_loaded_back(tmp_path):
+    graph = CompactCallGraph.from_edges(["a::f", "a::g", "b::h"], [(0, 1), (0, 2), (1, 2), (0, 1)])
+    snapshot_path = str(tmp_path / "graph.snap")
+    graph.save_snapshot(snapshot_path)
+
+    loaded_graph = CompactCallGraph.load_snapshot(snapshot_path)
+    assert loaded_graph.node_names == graph.node_names
+    assert sorted(loaded_graph.get_edges()) == [(0, 1), (0, 2), (1, 2)]
+    assert list(loaded_graph.predecessors(2)) == [0, 1]
+
+
+def test_snapshot_rewrite_keeps_the_mapped_graph_readable(tmp_path):
+    node_names = [f"a::f{i}" for i in range(5000)]
+    snapshot_path = str(tmp_path / "graph.snap")
+    CompactCallGraph.from_edges(node_names, [(i, i + 1) for i in range(4999)]).save_snapshot(snapshot_path)
+    loaded_graph = CompactCallGraph.load_snapshot(snapshot_path)
+
+    # rewriting the file in place would truncate the mapping and crash the next read with a bus error
+    CompactCallGraph.from_edges(["a::f"], []).save_snapshot(snapshot_path)
+    assert list(loaded_graph.predecessors(4999)) == [4998]
+    assert len(CompactCallGraph.load_snapshot(snapshot_path)) == 1
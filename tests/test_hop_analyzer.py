@@ -0,0 +1,79 @@
+import textwrap
+
+import pytest
+
+from afunc import AFunc
+from code_retriever import CodeRetriever
+from hop_analyzer import StaticHopAnalyzer
+
+RUNNER_MODULE = textwrap.dedent("""
+    from cache import Cache, load
+
+
+    class Runner:
+        def run(self, options, cache, key):
+            timeout = options.get("timeout")
+            if timeout is None:
+                return cache.get(key)
+            return None
+
+        def start(self):
+            load()
+            self.prepare()
+            Runner.stop()
+
+        def prepare(self):
+            pass
+
+        @classmethod
+        def stop(cls):
+            pass
+
+
+    def main(cache):
+        cache.load()
+        get()
+""")
+
+CACHE_MODULE = textwrap.dedent("""
+    def load():
+        pass
+
+
+    def get():
+        pass
+
+
+    class Cache:
+        def get(self, key):
+            pass
+
+        def load(self):
+            pass
+""")
+
+
+@pytest.fixture
+def hop_analyzer(tmp_path):
+    (tmp_path / "runner.py").write_text(RUNNER_MODULE)
+    (tmp_path / "cache.py").write_text(CACHE_MODULE)
+    return StaticHopAnalyzer(CodeRetriever(root_code_dir=str(tmp_path), root_test_dir=str(tmp_path)))
+
+
+def classify(hop_analyzer, source_node_name, destination_node_name):
+    return hop_analyzer.classify_hop([AFunc(node_name=source_node_name), AFunc(node_name=destination_node_name)], 0)
+
+
+@pytest.mark.parametrize("source_node_name, destination_node_name, classification", [
+    ("runner::Runner.run", "cache::Cache.get", StaticHopAnalyzer.AMBIGUOUS),
+    ("runner::Runner.start", "cache::load", StaticHopAnalyzer.DEFINITELY_CALLED),
+    ("runner::Runner.start", "runner::Runner.prepare", StaticHopAnalyzer.DEFINITELY_CALLED),
+    ("runner::Runner.start", "runner::Runner.stop", StaticHopAnalyzer.DEFINITELY_CALLED),
+    ("runner::Runner.start", "cache::Cache.get", StaticHopAnalyzer.DEFINITELY_NOT_CALLED),
+    ("runner::main", "cache::Cache.load", StaticHopAnalyzer.AMBIGUOUS),
+    ("runner::main", "cache::load", StaticHopAnalyzer.AMBIGUOUS),
+    ("runner::main", "cache::Cache.get", StaticHopAnalyzer.AMBIGUOUS),
+])
+def test_hops_are_only_decided_for_unambiguous_calls(hop_analyzer, source_node_name, destination_node_name,
+                                                      classification):
+    assert classify(hop_analyzer, source_node_name, destination_node_name) == classification
@@ -0,0 +1,111 @@
+import pytest
+
+import impact_index
+from afunc import AFunc
+from compact_graph import CompactCallGraph
+
+
+def create_graph(named_edges):
+    node_names = sorted({name for edge in named_edges for name in edge})
+    name_to_id = {name: node_id for node_id, name in enumerate(node_names)}
+    return CompactCallGraph.from_edges(node_names, [(name_to_id[u], name_to_id[v]) for u, v in named_edges])
+
+
+def get_path_names(paths):
+    return sorted([afunc.node_name for afunc in path] for path in paths)
+
+
+@pytest.fixture
+def graph():
+    # test_calls_helper only reaches compute through test_helper, a test function used as a helper
+    return create_graph([
+        ("tests::test_calls_helper", "tests::test_helper"),
+        ("tests::test_helper", "app::compute"),
+        ("tests::test_compute", "app::compute"),
+        ("tests::test_compute", "app::parse"),
+        ("app::parse", "app::compute"),
+        ("app::compute", "app::store"),
+        ("app::main", "app::store"),
+    ])
+
+
+def test_witness_paths_are_the_shortest_paths_from_every_test(graph):
+    index = impact_index.TestImpactIndex.build(graph)
+
+    assert get_path_names(index.find_all_test_paths(AFunc(node_name="app::store"))) == [
+        ["tests::test_calls_helper", "tests::test_helper", "app::compute", "app::store"],
+        ["tests::test_compute", "app::compute", "app::store"],
+        ["tests::test_helper", "app::compute", "app::store"],
+    ]
+    assert [afunc.node_name for afunc in index.get_reaching_tests(AFunc(node_name="app::parse"))] == \
+        ["tests::test_compute"]
+
+
+def test_test_functions_are_not_looked_up(graph):
+    index = impact_index.TestImpactIndex.build(graph)
+
+    assert AFunc(node_name="app::compute") in index
+    assert AFunc(node_name="tests::test_helper") not in index
+    with pytest.raises(Exception):
+        index.find_all_test_paths(AFunc(node_name="tests::test_helper"))
+
+
+def test_max_depth_leaves_out_the_farther_tests(graph):
+    index = impact_index.TestImpactIndex.build(graph, max_depth=2)
+
+    assert [afunc.node_name for afunc in index.get_reaching_tests(AFunc(node_name="app::store"))] == \
+        ["tests::test_compute", "tests::test_helper"]
+
+
+def test_saved_index_is_loaded_back(graph, tmp_path):
+    index = impact_index.TestImpactIndex.build(graph, max_depth=3, max_paths_per_test=2)
+    index_path = str(tmp_path / "impact.idx")
+    index.save(index_path)
+
+    loaded_index = impact_index.TestImpactIndex.load(index_path)
+    assert loaded_index.get_stats() == index.get_stats()
+    assert loaded_index.node_names == index.node_names
+    for node_name in ("app::compute", "app::parse", "app::store", "app::main"):
+        afunc = AFunc(node_name=node_name)
+        assert get_path_names(loaded_index.find_all_test_paths(afunc)) == \
+            get_path_names(index.find_all_test_paths(afunc))
+
+
+def test_index_rebuild_keeps_the_mapped_index_readable(tmp_path):
+    edges = [("tests::test_all", f"app::f{i}") for i in range(5000)]
+    index_path = str(tmp_path / "impact.idx")
+    impact_index.TestImpactIndex.build(create_graph(edges)).save(index_path)
+    loaded_index = impact_index.TestImpactIndex.load(index_path)
+
+    # rewriting the file in place would truncate the mapping and crash the next lookup with a bus error
+    impact_index.TestImpactIndex.build(create_graph(edges[:1])).save(index_path)
+    assert get_path_names(loaded_index.find_all_test_paths(AFunc(node_name="app::f4999"))) == \
+        [["tests::test_all", "app::f4999"]]
+    assert impact_index.TestImpactIndex.load(index_path).pairs_num == 1
+
+
+def test_other_files_are_not_loaded(tmp_path):
+    index_path = tmp_path / "impact.idx"
+    index_path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        impact_index.TestImpactIndex.load(str(index_path))
+
+
+def test_witness_paths_per_test_are_bounded():
+    # every diamond doubles the number of shortest paths: 2 ** 18 of them from the test to the last node
+    edges = []
+    previous_node = "tests::test_chain"
+    for diamond in range(18):
+        next_node = f"app::join_{diamond}"
+        edges += [(previous_node, f"app::left_{diamond}"), (previous_node, f"app::right_{diamond}"),
+                  (f"app::left_{diamond}", next_node), (f"app::right_{diamond}", next_node)]
+        previous_node = next_node
+    index = impact_index.TestImpactIndex.build(create_graph(edges))
+    target = AFunc(node_name=previous_node)
+
+    max_paths_per_test = impact_index.TestImpactIndex.DEFAULT_MAX_PATHS_PER_TEST
+    paths = index.find_all_test_paths(target)
+    assert len(paths) == max_paths_per_test
+    assert all(len(path) == 2 * 18 + 1 for path in paths)
+    assert len(index.find_all_test_paths(target, max_paths_per_test=1)) == 1
+    assert len(index.find_all_test_paths(target, max_paths_per_test=1000)) == max_paths_per_test
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from context_policy import ContextPolicy
+from llm import FakeChatModel, LLMBackend, LLMRouter
+
+
+class FailingChatModel(object):
+    model = "failing-llm"
+
+    def __init__(self):
+        self.calls_num = 0
+
+    def invoke(self, messages, *args, **kwargs):
+        self.calls_num += 1
+        raise ConnectionError("backend down")
+
+    async def ainvoke(self, messages, *args, **kwargs):
+        return self.invoke(messages)
+
+
+def create_router(*backends, **kwargs):
+    return LLMRouter(list(backends), base_backoff=0.0, **kwargs)
+
+
+def test_cancelled_call_releases_its_slot():
+    backend = LLMBackend("slow", FakeChatModel(latency=10.0), max_concurrency=1)
+    router = create_router(backend)
+
+    async def cancel_call():
+        call_task = asyncio.ensure_future(router.ainvoke([("user", "Is it called?")]))
+        await asyncio.sleep(0.05)
+        call_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call_task
+
+    asyncio.run(cancel_call())
+    assert backend.in_flight_num == 0
+    assert backend.errors_num == 0
+
+    backend.model.latency = 0.0
+    reply = asyncio.run(asyncio.wait_for(router.ainvoke([("user", "Is it called?")]), timeout=5.0))
+    assert reply.content == "Yes"
+
+
+def test_failed_call_fails_over_to_another_backend():
+    failing_backend = LLMBackend("failing", FailingChatModel())
+    healthy_backend = LLMBackend("healthy", FakeChatModel())
+    # the failing backend has the best (lowest) latency, so it is tried first
+    failing_backend.latency = 0.0
+    healthy_backend.latency = 1.0
+    router = create_router(failing_backend, healthy_backend)
+
+    assert router.invoke([("user", "Is it called?")]).content == "Yes"
+    assert failing_backend.errors_num == 1
+    assert healthy_backend.calls_num == 1
+    assert failing_backend.in_flight_num == healthy_backend.in_flight_num == 0
+
+
+def test_last_error_is_raised_after_max_attempts():
+    backend = LLMBackend("failing", FailingChatModel())
+    router = create_router(backend, max_attempts=2)
+
+    with pytest.raises(ConnectionError):
+        router.invoke([("user", "Is it called?")])
+    assert backend.model.calls_num == 2
+    assert backend.in_flight_num == 0
+
+
+def test_repeated_failures_make_a_backend_cool_down():
+    backend = LLMBackend("failing", FailingChatModel())
+    router = create_router(backend, max_attempts=LLMBackend.FAILURE_THRESHOLD)
+
+    with pytest.raises(ConnectionError):
+        router.invoke([("user", "Is it called?")])
+    assert router.get_stats()[0]["healthy"] is False
+
+
+def test_model_names_all_backends():
+    router = create_router(LLMBackend("a", FakeChatModel(model="model-b")),
+                           LLMBackend("b", FakeChatModel(model="model-a")),
+                           LLMBackend("c", FakeChatModel(model="model-a")))
+    assert router.model == "model-a+model-b"
+    assert router.bind_tools([]).model == router.model
+
+
+def test_router_and_replies_estimate_the_tokens_alike():
+    messages = [("system", "You are a helpful assistant."), ("user", "Is 'a::f' invoking 'b::g'?")]
+    reply = FakeChatModel().invoke(messages)
+
+    assert reply.usage_metadata["input_tokens"] == ContextPolicy.estimate_tokens_num(messages)
+    assert ContextPolicy.estimate_tokens_num(messages) == \
+        ContextPolicy.estimate_tokens_num([SystemMessage(content=messages[0][1]), HumanMessage(content=messages[1][1])])
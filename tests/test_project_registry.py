@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from project_registry import ProjectRegistry
+
+
+@pytest.fixture
+def registry():
+    registry = ProjectRegistry(llm_factory=lambda: None)
+    registry.VALIDATION_INTERVAL = 0.0
+    return registry
+
+
+@pytest.fixture
+def project_dirs(tmp_path):
+    code_dir, test_dir = tmp_path / "src", tmp_path / "tests"
+    code_dir.mkdir()
+    test_dir.mkdir()
+    (code_dir / "app.py").write_text("def compute():\n    return 1\n")
+    (code_dir / "legacy.py").write_text("print 'python 2'\n")
+    (test_dir / "test_app.py").write_text("from app import compute\n\n\ndef test_compute():\n    compute()\n")
+    return str(code_dir), str(test_dir)
+
+
+def touch(file_path, mtime_offset):
+    mtime = os.path.getmtime(file_path) + mtime_offset
+    os.utime(file_path, (mtime, mtime))
+
+
+def test_projects_with_modules_which_cannot_be_parsed_are_validated(registry, project_dirs):
+    code_dir, test_dir = project_dirs
+    project = registry.preload(code_dir, test_dir, call_graph_backend="ast")
+
+    touch(os.path.join(code_dir, "app.py"), 10)
+    assert registry.get_project(code_dir, test_dir, call_graph_backend="ast") is project
+    assert project.validation_error is None
+    assert project.call_graph_creator.get_build_stats()["modules"] == 3
+
+
+def test_failed_reload_does_not_fail_the_later_validations(registry, project_dirs):
+    code_dir, test_dir = project_dirs
+    project = registry.get_project(code_dir, test_dir, call_graph_backend="ast")
+    refreshes = []
+
+    def refresh_index():
+        refreshes.append(True)
+        raise OSError("permission denied")
+    project.code_retriever.refresh_index = refresh_index
+
+    touch(os.path.join(code_dir, "app.py"), 10)
+    registry.get_project(code_dir, test_dir, call_graph_backend="ast")
+    assert project.get_stats()["validation_error"] == "OSError: permission denied"
+    registry.get_project(code_dir, test_dir, call_graph_backend="ast")
+    assert len(refreshes) == 1
@@ -0,0 +1,13 @@
+from symbol_index import SymbolIndex
+
+
+def test_modules_which_cannot_be_parsed_have_no_symbols(tmp_path):
+    (tmp_path / "good.py").write_text("class A:\n    def f(self):\n        pass\n")
+    (tmp_path / "legacy.py").write_text("print 'python 2'\n")
+    (tmp_path / "data.py").write_bytes(b"x = '\xff'\n")
+    symbol_index = SymbolIndex(str(tmp_path))
+
+    symbol_index.build(max_workers=1)
+    assert symbol_index.find_symbol("good", "A", "f") == (str(tmp_path / "good.py"), [(2, 3)])
+    assert symbol_index.find_symbol("legacy", None, "f") == (str(tmp_path / "legacy.py"), None)
+    assert symbol_index.find_symbol("data", None, "f") == (str(tmp_path / "data.py"), None)
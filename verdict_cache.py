@@ -0,0 +1,95 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+class VerdictCache(object):
+    """
+    A persistent content-addressed cache of the LLM verdicts on single hops.
+    The keys are derived from the model name, the prompt template version and the hashes of the source code of the
+    functions taking part in the hop, so editing unrelated functions does not invalidate the cached verdicts.
+    The least recently used entries are evicted once the cache grows beyond max_entries.
+    """
+    DEFAULT_MAX_ENTRIES = 100000
+    EVICTION_CHECK_INTERVAL = 100
+
+    def __init__(self, db_path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.__db_path = db_path
+        self.__max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS verdicts ("
+                                  "key TEXT PRIMARY KEY, verdict TEXT, prompt TEXT, reply TEXT, last_access REAL)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS verdicts_last_access ON verdicts(last_access)")
+        self.__connection.commit()
+        self.__puts_since_eviction_check = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def create_key(*parts):
+        return hashlib.sha256("\0".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns a tuple (verdict, prompt, reply) or None if the key is not in the cache.
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT verdict, prompt, reply FROM verdicts WHERE key = ?",
+                                            (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.increment("verdict_cache.misses")
+                return None
+            self.hits += 1
+            metrics.increment("verdict_cache.hits")
+            self.__connection.execute("UPDATE verdicts SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.__connection.commit()
+            return row
+
+    def put(self, key, verdict, prompt, reply):
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)",
+                                      (key, verdict, prompt, reply, time.time()))
+            self.__puts_since_eviction_check += 1
+            if self.__puts_since_eviction_check >= self.EVICTION_CHECK_INTERVAL:
+                self.__evict()
+            self.__connection.commit()
+
+    def __evict(self):
+        self.__puts_since_eviction_check = 0
+        entries_num = self.__connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        if entries_num <= self.__max_entries:
+            return
+        self.__connection.execute("DELETE FROM verdicts WHERE key IN "
+                                  "(SELECT key FROM verdicts ORDER BY last_access LIMIT ?)",
+                                  (entries_num - self.__max_entries,))
+        self.evictions += entries_num - self.__max_entries
+
+    def purge(self):
+        with self.__lock:
+            self.__connection.execute("DELETE FROM verdicts")
+            self.__connection.commit()
+            self.hits = self.misses = self.evictions = 0
+
+    def get_stats(self):
+        with self.__lock:
+            entries_num = self.__connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        lookups_num = self.hits + self.misses
+        return {
+            "db_path": self.__db_path,
+            "entries": entries_num,
+            "max_entries": self.__max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups_num if lookups_num > 0 else 0.0,
+        }
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
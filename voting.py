@@ -0,0 +1,52 @@
+class VotingStrategy(object):
+    """
+    Decides whether a path reaches the target function based on the results of several independent state graph runs.
+    The voting stops as soon as the outcome can no longer change:
+    - the path is accepted once 'quorum' positive votes were cast;
+    - the path is rejected once enough negative votes were cast for the quorum to be unreachable;
+    - if confidence_threshold is set, the leading side also wins once at least two votes were cast and its share
+      of the votes cast so far reaches the threshold.
+    Up to parallel_votes votes (the quorum by default) may be run speculatively at the same time, the remaining ones are
+    cancelled once the outcome is decided.
+    max_steps_per_vote bounds the number of state graph steps in a single run (None means that the bound is derived
+    from the length of the path).
+    """
+    STEPS_PER_HOP = 10
+
+    def __init__(self, vote_num=3, quorum=None, confidence_threshold=None, parallel_votes=None,
+                 max_steps_per_vote=None):
+        if vote_num < 1:
+            raise ValueError(f"The number of votes must be positive, got {vote_num}.")
+        if quorum is None:
+            quorum = vote_num // 2 + 1
+        if not 1 <= quorum <= vote_num:
+            raise ValueError(f"The quorum must be between 1 and {vote_num}, got {quorum}.")
+        if confidence_threshold is not None and not 0.5 < confidence_threshold <= 1:
+            raise ValueError(f"The confidence threshold must be in (0.5, 1], got {confidence_threshold}.")
+
+        self.vote_num = vote_num
+        self.quorum = quorum
+        self.confidence_threshold = confidence_threshold
+        self.parallel_votes = quorum if parallel_votes is None else max(1, min(parallel_votes, vote_num))
+        self.max_steps_per_vote = max_steps_per_vote
+
+    def get_decision(self, positive_votes_num, negative_votes_num):
+        """
+        Returns True if the path is accepted, False if it is rejected and None if more votes are needed.
+        """
+        if positive_votes_num >= self.quorum:
+            return True
+        if negative_votes_num > self.vote_num - self.quorum:
+            return False
+        votes_num = positive_votes_num + negative_votes_num
+        if self.confidence_threshold is not None and votes_num >= 2:
+            if positive_votes_num / votes_num >= self.confidence_threshold:
+                return True
+            if negative_votes_num / votes_num >= self.confidence_threshold:
+                return False
+        return None
+
+    def get_recursion_limit(self, path):
+        if self.max_steps_per_vote is not None:
+            return self.max_steps_per_vote
+        return len(path) * self.STEPS_PER_HOP